@@ -0,0 +1,144 @@
+"""Set-based per-agent metrics for the dashboards and the performance report.
+
+Metrics are read from the incrementally maintained monthly rollups (see
+rollups.py) plus one grouped Task query, so the number of queries depends on
+neither the number of agents nor the size of the ledger.
+"""
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import case
+
+from models import db, Task, AgentMonthRollup
+
+
+METRIC_KEYS = (
+    'total_income', 'month_income', 'month_income_count',
+    'total_expenses', 'month_expenses',
+    'tasks_assigned', 'tasks_completed', 'tasks_open', 'tasks_overdue',
+    'cars_this_month', 'total_cars',
+)
+
+
+def month_bounds(day):
+    """Return (first day of the month, first day of the next month) for a date"""
+    first = day.replace(day=1)
+    return first, (first + timedelta(days=32)).replace(day=1)
+
+
+def parse_month(month):
+    """Accept a date or a 'YYYY-MM' string and return the first day of that month"""
+    if isinstance(month, str):
+        return datetime.strptime(month, '%Y-%m').date()
+    return month.replace(day=1)
+
+
+def month_range(column, first, last=None):
+    """Return index-friendly criteria selecting months ``first``..``last`` of a column.
+
+    Months are dates or 'YYYY-MM' strings. The column is compared against
+    half-open bounds instead of being wrapped in strftime(), so SQLite can
+    range-scan an index on it. DateTime columns get midnight bounds.
+    """
+    start = parse_month(first)
+    end = month_bounds(parse_month(last) if last is not None else start)[1]
+    if isinstance(column.type, db.DateTime):
+        start, end = datetime.combine(start, time.min), datetime.combine(end, time.min)
+    return [column >= start, column < end]
+
+
+def _empty_metrics():
+    return dict.fromkeys(METRIC_KEYS, 0)
+
+
+def agent_metrics(today=None):
+    """Compute all per-agent metrics in two grouped queries.
+
+    Ledger totals, completed tasks and cars come from the AgentMonthRollup
+    table; only open tasks are read from Task, through the covering
+    ix_task_open_due index, and assigned is completed plus open. Returns a
+    defaultdict keyed by agent_id; rows without an agent are kept under the
+    ``None`` key so that global totals stay exact. Agents with no activity
+    get an all-zero entry on first access.
+    """
+    today = today or date.today()
+    metrics = defaultdict(_empty_metrics)
+
+    R = AgentMonthRollup
+    in_month = (R.year == today.year) & (R.month == today.month)
+    rows = db.session.query(
+        R.agent_id,
+        db.func.sum(R.income_sum),
+        db.func.sum(case((in_month, R.income_sum), else_=0)),
+        db.func.sum(case((in_month, R.income_count), else_=0)),
+        db.func.sum(R.purchase_sum),
+        db.func.sum(case((in_month, R.purchase_sum), else_=0)),
+        db.func.sum(R.tasks_completed),
+        db.func.sum(case((in_month, R.cars_wrapped), else_=0)),
+        db.func.sum(R.cars_wrapped),
+    ).group_by(R.agent_id)
+    for agent_id, *values in rows:
+        m = metrics[agent_id or None]
+        (m['total_income'], m['month_income'], m['month_income_count'],
+         m['total_expenses'], m['month_expenses'], m['tasks_completed'],
+         m['cars_this_month'], m['total_cars']) = (v or 0 for v in values)
+        m['tasks_assigned'] = m['tasks_completed']
+
+    rows = db.session.query(
+        Task.agent_id,
+        db.func.count(),
+        db.func.sum(case((Task.due_date >= today, 1), else_=0)),
+        db.func.sum(case((Task.due_date < today, 1), else_=0)),
+    ).filter(Task.completed == False).group_by(Task.agent_id)
+    for agent_id, pending, open_, overdue in rows:
+        m = metrics[agent_id]
+        m['tasks_assigned'] += pending
+        m['tasks_open'] = open_ or 0
+        m['tasks_overdue'] = overdue or 0
+
+    return metrics
+
+
+def month_rollups(year, month):
+    """Return {agent_id: AgentMonthRollup} for one calendar month"""
+    rows = AgentMonthRollup.query.filter_by(year=year, month=month).all()
+    return {r.agent_id or None: r for r in rows}
+
+
+def totals(metrics):
+    """Sum every metric across all agents (including unassigned rows)"""
+    out = _empty_metrics()
+    for m in metrics.values():
+        for key in METRIC_KEYS:
+            out[key] += m[key]
+    return out
+
+
+def monthly_series(model, *criteria):
+    """Return one {'month': 'YYYY-MM', 'amount': total} row per month, oldest first.
+
+    ``model`` is Income or Purchase. ``criteria`` are applied before grouping,
+    so the series honors the same agent/date filters as the page listing.
+    """
+    month = db.func.strftime('%Y-%m', model.date)
+    rows = db.session.query(month, db.func.sum(model.amount)).filter(
+        model.date.isnot(None), *criteria
+    ).group_by(month).order_by(month)
+    return [{'month': m, 'amount': total or 0} for m, total in rows]
+
+
+def rollup_series(kind, *criteria):
+    """``monthly_series()`` read from the rollups instead of the ledger.
+
+    ``kind`` is 'income' or 'purchase'. ``criteria`` filter AgentMonthRollup
+    (e.g. by agent_id), so a date range still needs ``monthly_series()``.
+    Undated rows (month 0) are left out, as they are there.
+    """
+    total = db.func.sum(getattr(AgentMonthRollup, f'{kind}_sum'))
+    count = db.func.sum(getattr(AgentMonthRollup, f'{kind}_count'))
+    rows = db.session.query(AgentMonthRollup.year, AgentMonthRollup.month, total).filter(
+        AgentMonthRollup.month > 0, *criteria
+    ).group_by(AgentMonthRollup.year, AgentMonthRollup.month).having(count > 0).order_by(
+        AgentMonthRollup.year, AgentMonthRollup.month
+    )
+    return [{'month': f'{y:04d}-{m:02d}', 'amount': amount or 0} for y, m, amount in rows]
@@ -0,0 +1,134 @@
+"""Bearer-token authentication for the JSON API.
+
+Clients send ``Authorization: Bearer <token>`` (``Token <token>`` is
+accepted too). Only the SHA-256 digest of a token is stored; lookups go
+through a per-worker cache of digest -> token for API_TOKEN_CACHE_TTL
+seconds. Only valid tokens are cached, so the cache is bounded by the
+number of issued tokens. Revoking a token bumps the API_TOKEN_CACHE_STAMP file, which
+empties the cache in every worker (see stamps.py).
+
+Usage counts and last-used times are accumulated in memory and written in
+one batch at most every API_USAGE_FLUSH_SECONDS, and at exit.
+"""
+import atexit
+import hashlib
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import g, jsonify, request
+from flask_login import current_user
+
+from models import db, APIToken
+import stamps
+
+
+_app = None
+_cache = {}
+_stamp = None
+_usage = {}
+_last_flush = time.monotonic()
+_lock = threading.Lock()
+
+
+def init_app(app):
+    global _app
+    _app = app
+    atexit.register(flush_usage)
+
+
+def digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _bearer_token():
+    scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() in ('bearer', 'token') and value.strip():
+        return value.strip()
+    return None
+
+
+def verify(token):
+    """Return (token_id, created_by) for a valid, unrevoked token, else None"""
+    global _stamp
+    key = digest(token)
+    now = time.monotonic()
+    stamp = stamps.read(_app.config['API_TOKEN_CACHE_STAMP'])
+    with _lock:
+        if stamp != _stamp:
+            _cache.clear()
+            _stamp = stamp
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+    row = db.session.query(APIToken.id, APIToken.created_by).filter(
+        APIToken.token_digest == key, APIToken.revoked.isnot(True)
+    ).first()
+    if row is None:
+        # misses are not cached: their keys are chosen by the caller
+        return None
+    result = (row.id, row.created_by)
+    with _lock:
+        if _stamp == stamp:
+            _cache[key] = (now + _app.config.get('API_TOKEN_CACHE_TTL', 300), result)
+    return result
+
+
+def invalidate():
+    """Drop cached verifications in every worker, e.g. after a revoke"""
+    with _lock:
+        _cache.clear()
+    stamps.bump(_app.config['API_TOKEN_CACHE_STAMP'])
+
+
+def _note_use(token_id):
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        count, _ = _usage.get(token_id, (0, None))
+        _usage[token_id] = (count + 1, datetime.utcnow())
+        due = now - _last_flush >= _app.config.get('API_USAGE_FLUSH_SECONDS', 30)
+        if due:
+            _last_flush = now
+    if due:
+        flush_usage()
+
+
+def flush_usage():
+    """Write the accumulated per-token usage in one transaction"""
+    with _lock:
+        pending = list(_usage.items())
+        _usage.clear()
+    if not pending or _app is None:
+        return
+    table = APIToken.__table__
+    stmt = table.update().where(table.c.id == db.bindparam('token_id')).values(
+        use_count=db.func.coalesce(table.c.use_count, 0) + db.bindparam('uses'),
+        last_used_at=db.bindparam('used_at'),
+    )
+    rows = [{'token_id': i, 'uses': n, 'used_at': at} for i, (n, at) in pending]
+    try:
+        with _app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(stmt, rows)
+    except Exception as e:
+        print(f"Could not record API token usage: {e}")
+
+
+def api_auth_required(view):
+    """Accept a valid bearer token, or fall back to the session login"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        token = _bearer_token()
+        if token is not None:
+            found = verify(token)
+            if found is None:
+                return jsonify({'error': 'invalid or revoked token'}), 401
+            g.api_token_id, g.api_token_owner = found
+            _note_use(found[0])
+            return view(*args, **kwargs)
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'authentication required'}), 401
+        return view(*args, **kwargs)
+    return wrapped
@@ -2,16 +2,34 @@ import os
 import io
 import zipfile
 import secrets
-from datetime import datetime
+import hashlib
+import tempfile
+from datetime import datetime, timedelta
 
-import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, jsonify, g, session
+import click
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, send_from_directory, send_file, abort, jsonify, g, session
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from sqlalchemy import text
-
-from models import db, Admin, Agent, Task, FileUpload, Purchase, Income, Log, APIToken, ServiceType, CarType
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Admin, Agent, Task, FileUpload, Purchase, Income, Log, APIToken, ServiceType, CarType, ImportJob, AgentMonthRollup
+from aggregates import agent_metrics, month_range, month_rollups, monthly_series, rollup_series, totals
+from pagination import keyset_page, list_page
+import rollups
+import migrations
+import api_auth
+import audit
+import catalog
+import changes
+import identity
+import invoice_export
+import invoices
+import jobs
+import log_archive
+import passwords
 import config
 from translations import get_translation
 
@@ -25,95 +43,66 @@ if not os.path.exists(app.config['UPLOAD_FOLDER']):
 
 # init database
 db.init_app(app)
+audit.init_app(app)
+api_auth.init_app(app)
+identity.init_app(app)
+invoices.init_app(app)
+catalog.init_app(app)
+invoice_export.init_app(app)
+passwords.init_app(app)
 
 # Flask-Login setup
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
-# One-time startup flag
-_startup_done = False
-
 @login_manager.user_loader
 def load_user(user_id):
-    # user_id is prefixed: "admin:<id>" or "agent:<id>"
-    try:
-        kind, raw_id = str(user_id).split(":", 1)
-        _id = int(raw_id)
-        if kind == 'admin':
-            return db.session.get(Admin, _id)
-        if kind == 'agent':
-            return db.session.get(Agent, _id)
-    except Exception:
-        pass
-    return None
+    # user_id is prefixed: "admin:<id>" or "agent:<id>"; served from the identity cache
+    return identity.load(user_id)
 
 
-@app.before_request
-def create_tables():
-    global _startup_done
-    if _startup_done:
-        return
-    _startup_done = True
-    
-    db.create_all()
-    if not Admin.query.filter_by(username='admin').first():
-        admin = Admin(username='admin', password_hash=generate_password_hash('admin123'))
-        db.session.add(admin)
-        db.session.commit()
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations (run once per deploy)"""
+    applied = migrations.upgrade(db.engine)
+    for name in applied:
+        print(f'Applied {name}')
+    print('Database is up to date' if not applied else f'{len(applied)} migration(s) applied')
 
-    # Lightweight migration: ensure agent login columns exist
-    try:
-        with db.engine.begin() as conn:
-            # Agent table migrations
-            cols = conn.exec_driver_sql("PRAGMA table_info(agent)").fetchall()
-            names = {row[1] for row in cols}
-            statements = []
-            if 'username' not in names:
-                statements.append("ALTER TABLE agent ADD COLUMN username TEXT")
-            if 'password_hash' not in names:
-                statements.append("ALTER TABLE agent ADD COLUMN password_hash TEXT")
-            if 'is_active' not in names:
-                statements.append("ALTER TABLE agent ADD COLUMN is_active INTEGER DEFAULT 1")
-            for stmt in statements:
-                conn.exec_driver_sql(stmt)
-            conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS idx_agent_username ON agent(username) WHERE username IS NOT NULL")
-            
-            # Income table migration: add agent_id, customer_name, service_type, car_type, invoice_number
-            income_cols = conn.exec_driver_sql("PRAGMA table_info(income)").fetchall()
-            income_names = {row[1] for row in income_cols}
-            income_statements = []
-            if 'agent_id' not in income_names:
-                income_statements.append("ALTER TABLE income ADD COLUMN agent_id INTEGER")
-            if 'customer_name' not in income_names:
-                income_statements.append("ALTER TABLE income ADD COLUMN customer_name TEXT")
-            if 'service_type' not in income_names:
-                income_statements.append("ALTER TABLE income ADD COLUMN service_type TEXT")
-            if 'car_type' not in income_names:
-                income_statements.append("ALTER TABLE income ADD COLUMN car_type TEXT")
-            if 'invoice_number' not in income_names:
-                income_statements.append("ALTER TABLE income ADD COLUMN invoice_number TEXT")
-            for stmt in income_statements:
-                conn.exec_driver_sql(stmt)
-            
-            # Task table migration: add completed, completed_at, income_id, car_count
-            task_cols = conn.exec_driver_sql("PRAGMA table_info(task)").fetchall()
-            task_names = {row[1] for row in task_cols}
-            task_statements = []
-            if 'completed' not in task_names:
-                task_statements.append("ALTER TABLE task ADD COLUMN completed INTEGER DEFAULT 0")
-            if 'completed_at' not in task_names:
-                task_statements.append("ALTER TABLE task ADD COLUMN completed_at TEXT")
-            if 'income_id' not in task_names:
-                task_statements.append("ALTER TABLE task ADD COLUMN income_id INTEGER")
-            if 'car_count' not in task_names:
-                task_statements.append("ALTER TABLE task ADD COLUMN car_count INTEGER DEFAULT 0")
-            for stmt in task_statements:
-                conn.exec_driver_sql(stmt)
-        
-        db.engine.dispose()
-    except Exception:
-        pass
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the per-agent monthly rollup table from the ledger"""
+    count = rollups.rebuild(db.session.connection())
+    db.session.commit()
+    print(f'Rebuilt {count} rollup rows')
+
+
+@app.cli.command('archive-logs')
+@click.option('--days', type=int, default=None, help='Archive logs older than this many days (default: LOG_RETENTION_DAYS)')
+def archive_logs_command(days):
+    """Move old audit logs to the monthly gzip archives and compact the database"""
+    audit.flush()
+    moved = log_archive.archive_logs(app, days)
+    print(f'Archived {moved} log entries' if moved else 'Nothing to archive')
+
+
+@app.cli.command('recover-imports')
+def recover_imports_command():
+    """Fail interrupted import jobs and run the queued ones (after a restart)"""
+    failed = jobs.fail_stale(app)
+    queued = jobs.recover(app)
+    jobs.shutdown()
+    print(f'{failed} interrupted job(s) marked failed, {queued} queued job(s) run')
+
+
+@app.cli.command('prune-changes')
+@click.option('--days', type=int, default=None, help='Drop delete entries older than this many days (default: CHANGE_RETENTION_DAYS)')
+def prune_changes_command(days):
+    """Prune old delete entries from the /api/changes feed"""
+    removed = changes.prune(app, days)
+    print(f'Pruned {removed} change entries' if removed else 'Nothing to prune')
 
 
 @app.before_request
@@ -125,6 +114,12 @@ def set_language():
     g.t = lambda key: get_translation(key, g.lang)
 
 
+def agent_load(model):
+    """Loader option for ``model.agent`` in list views: joined into the same query, or selectin (AGENT_EAGER_LOADING)"""
+    loader = selectinload if app.config.get('AGENT_EAGER_LOADING') == 'selectin' else joinedload
+    return loader(model.agent)
+
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -178,49 +173,34 @@ def toggle_language():
 @app.route('/admin')
 @login_required
 def admin_dashboard():
-    from datetime import date
-    from dateutil.relativedelta import relativedelta
-    
     agents = Agent.query.all()
     files = FileUpload.query.order_by(FileUpload.uploaded_at.desc()).limit(5).all()
     tasks = Task.query.order_by(Task.assigned_at.desc()).limit(10).all()
     
-    # Current month stats
-    today = date.today()
-    first_day = today.replace(day=1)
-    
-    # Purchases this month
-    purchases_month = Purchase.query.filter(Purchase.date >= first_day).all()
-    total_purchases = sum(p.amount for p in purchases_month)
+    # Current month stats, grouped per agent in the database
+    metrics = agent_metrics()
+    overall = totals(metrics)
     
-    # Income this month
-    income_month = Income.query.filter(Income.date >= first_day).all()
-    total_income = sum(i.amount for i in income_month)
+    total_purchases = overall['month_expenses']
+    total_income = overall['month_income']
     
     # Profit
     profit = total_income - total_purchases
     
-    # Open tasks
-    open_tasks = Task.query.filter(Task.due_date >= today).count()
-    overdue_tasks = Task.query.filter(Task.due_date < today).count()
-    
-    # Top performing agent
-    agent_stats = {}
-    for p in purchases_month:
-        if p.agent_id:
-            agent_stats[p.agent_id] = agent_stats.get(p.agent_id, 0) + p.amount
+    # Top performing agent (by purchases this month)
+    agent_stats = {aid: m['month_expenses'] for aid, m in metrics.items() if aid and m['month_expenses']}
     
     top_agent = None
     if agent_stats:
         top_agent_id = max(agent_stats, key=agent_stats.get)
-        top_agent = Agent.query.get(top_agent_id)
+        top_agent = next((a for a in agents if a.id == top_agent_id), None)
     
     stats = {
         'total_purchases': total_purchases,
         'total_income': total_income,
         'profit': profit,
-        'open_tasks': open_tasks,
-        'overdue_tasks': overdue_tasks,
+        'open_tasks': overall['tasks_open'],
+        'overdue_tasks': overall['tasks_overdue'],
         'top_agent': top_agent,
         'agents_count': len(agents)
     }
@@ -240,73 +220,24 @@ def agents_list():
 @login_required
 def performance_report():
     """Performance report for all agents"""
-    from datetime import date
-    from dateutil.relativedelta import relativedelta
-    
     agents = Agent.query.all()
+    metrics = agent_metrics()
     report_data = []
     
     for agent in agents:
-        # Total income (not purchases)
-        incomes = Income.query.filter_by(agent_id=agent.id).all()
-        total_income = sum(i.amount for i in incomes)
-        
-        # This month income
-        today = date.today()
-        first_day = today.replace(day=1)
-        month_incomes = Income.query.filter(
-            Income.agent_id == agent.id,
-            Income.date >= first_day
-        ).all()
-        month_income = sum(i.amount for i in month_incomes)
-        
-        # Total purchases (expenses)
-        purchases = Purchase.query.filter_by(agent_id=agent.id).all()
-        total_expenses = sum(p.amount for p in purchases)
-        
-        # This month expenses
-        month_purchases = Purchase.query.filter(
-            Purchase.agent_id == agent.id,
-            Purchase.date >= first_day
-        ).all()
-        month_expenses = sum(p.amount for p in month_purchases)
-        
-        # Tasks statistics
-        tasks_assigned = Task.query.filter_by(agent_id=agent.id).count()
-        tasks_completed = Task.query.filter(
-            Task.agent_id == agent.id,
-            Task.completed == True
-        ).count()
-        
-        # Cars wrapped this month
-        cars_this_month = db.session.query(db.func.sum(Task.car_count)).filter(
-            Task.agent_id == agent.id,
-            Task.completed == True,
-            db.func.strftime('%Y-%m', Task.completed_at) == today.strftime('%Y-%m')
-        ).scalar() or 0
-        
-        # Total cars wrapped
-        total_cars = db.session.query(db.func.sum(Task.car_count)).filter(
-            Task.agent_id == agent.id,
-            Task.completed == True
-        ).scalar() or 0
-        
-        # Net profit
-        net_profit_total = total_income - total_expenses
-        net_profit_month = month_income - month_expenses
-        
+        m = metrics[agent.id]
         report_data.append({
             'agent': agent,
-            'total_income': total_income,
-            'month_income': month_income,
-            'total_expenses': total_expenses,
-            'month_expenses': month_expenses,
-            'net_profit_total': net_profit_total,
-            'net_profit_month': net_profit_month,
-            'tasks_assigned': tasks_assigned,
-            'tasks_completed': tasks_completed,
-            'cars_this_month': cars_this_month,
-            'total_cars': total_cars
+            'total_income': m['total_income'],
+            'month_income': m['month_income'],
+            'total_expenses': m['total_expenses'],
+            'month_expenses': m['month_expenses'],
+            'net_profit_total': m['total_income'] - m['total_expenses'],
+            'net_profit_month': m['month_income'] - m['month_expenses'],
+            'tasks_assigned': m['tasks_assigned'],
+            'tasks_completed': m['tasks_completed'],
+            'cars_this_month': m['cars_this_month'],
+            'total_cars': m['total_cars']
         })
     
     # Sort by month income descending
@@ -332,20 +263,19 @@ def agent_new():
         while Agent.query.filter_by(username=username).first():
             idx += 1
             username = f"{base}.{idx}"
-        temp_password = secrets.token_urlsafe(8)
+        temp_password, password_hash = passwords.new_credential()
         agent = Agent(
             name=name,
             phone=phone,
             email=email,
             params=params,
             username=username,
-            password_hash=generate_password_hash(temp_password),
+            password_hash=password_hash,
         )
         db.session.add(agent)
-        db.session.commit()
         if isinstance(current_user, Admin):
-            db.session.add(Log(action='create_agent', detail=f'Agent {name} created with username: {username}', created_by=current_user.id))
-            db.session.commit()
+            audit.record('create_agent', f'Agent {name} created with username: {username}', current_user.id, sync=True)
+        db.session.commit()
         flash(f"✅ Agent created successfully!\n🔑 Username: {username}\n🔐 Temporary Password: {temp_password}\n⚠️ Save this password - it will not be shown again!", 'success')
         return redirect(url_for('agents_list'))
     return render_template('agent_form.html', agent=None)
@@ -363,48 +293,13 @@ def agent_dashboard():
     
     # Personal statistics
     from datetime import date
-    from dateutil.relativedelta import relativedelta
     
     today = date.today()
-    first_day = today.replace(day=1)
-    
-    # Income by this agent
-    all_incomes = Income.query.filter_by(agent_id=current_user.id).all()
-    month_incomes = Income.query.filter(
-        Income.agent_id == current_user.id,
-        Income.date >= first_day
-    ).all()
-    
-    total_income_all_time = sum(i.amount for i in all_incomes)
-    total_income_this_month = sum(i.amount for i in month_incomes)
-    
-    # Purchases by this agent
-    all_purchases = Purchase.query.filter_by(agent_id=current_user.id).all()
-    month_purchases = Purchase.query.filter(
-        Purchase.agent_id == current_user.id,
-        Purchase.date >= first_day
-    ).all()
-    
-    total_purchases_all_time = sum(p.amount for p in all_purchases)
-    total_purchases_this_month = sum(p.amount for p in month_purchases)
-    
-    # Tasks
-    open_tasks = Task.query.filter(
-        Task.agent_id == current_user.id,
-        Task.due_date >= today
-    ).count()
-    
-    overdue_tasks = Task.query.filter(
-        Task.agent_id == current_user.id,
-        Task.due_date < today
-    ).count()
-    
-    # Calculate ranking based on income
-    agent_stats = {}
-    all_month_incomes = Income.query.filter(Income.date >= first_day).all()
-    for inc in all_month_incomes:
-        if inc.agent_id:
-            agent_stats[inc.agent_id] = agent_stats.get(inc.agent_id, 0) + inc.amount
+    metrics = agent_metrics(today)
+    mine = metrics[current_user.id]
+    
+    # Calculate ranking based on income this month
+    agent_stats = {aid: m['month_income'] for aid, m in metrics.items() if aid and m['month_income_count']}
     
     sorted_agents = sorted(agent_stats.items(), key=lambda x: x[1], reverse=True)
     ranking = None
@@ -414,12 +309,12 @@ def agent_dashboard():
             break
     
     stats = {
-        'total_income_all_time': total_income_all_time,
-        'total_income_this_month': total_income_this_month,
-        'total_purchases_all_time': total_purchases_all_time,
-        'total_purchases_this_month': total_purchases_this_month,
-        'open_tasks': open_tasks,
-        'overdue_tasks': overdue_tasks,
+        'total_income_all_time': mine['total_income'],
+        'total_income_this_month': mine['month_income'],
+        'total_purchases_all_time': mine['total_expenses'],
+        'total_purchases_this_month': mine['month_expenses'],
+        'open_tasks': mine['tasks_open'],
+        'overdue_tasks': mine['tasks_overdue'],
         'ranking': ranking,
         'total_agents': len(agent_stats)
     }
@@ -441,10 +336,10 @@ def agent_edit(agent_id):
             agent.username = request.form['username']
         if 'new_password' in request.form and request.form['new_password']:
             agent.password_hash = generate_password_hash(request.form['new_password'])
-        db.session.commit()
         if isinstance(current_user, Admin):
-            db.session.add(Log(action='edit_agent', detail=f'Agent {agent.name} edited', created_by=current_user.id))
-            db.session.commit()
+            audit.record('edit_agent', f'Agent {agent.name} edited', current_user.id, sync=True)
+        db.session.commit()
+        identity.invalidate(agent.get_id())
         return redirect(url_for('agents_list'))
     return render_template('agent_form.html', agent=agent)
 
@@ -455,10 +350,10 @@ def agent_delete(agent_id):
     agent = Agent.query.get_or_404(agent_id)
     name = agent.name
     db.session.delete(agent)
-    db.session.commit()
     if isinstance(current_user, Admin):
-        db.session.add(Log(action='delete_agent', detail=f'Agent {name} deleted', created_by=current_user.id))
-        db.session.commit()
+        audit.record('delete_agent', f'Agent {name} deleted', current_user.id, sync=True)
+    db.session.commit()
+    identity.invalidate(f'agent:{agent_id}')
     return redirect(url_for('agents_list'))
 
 
@@ -469,18 +364,18 @@ def agent_reset_password(agent_id):
     agent = Agent.query.get_or_404(agent_id)
     
     # Generate new temporary password
-    new_password = secrets.token_urlsafe(8)
-    agent.password_hash = generate_password_hash(new_password)
-    db.session.commit()
+    new_password, agent.password_hash = passwords.new_credential()
     
     # Log the action
     if isinstance(current_user, Admin):
-        db.session.add(Log(
-            action='reset_agent_password', 
-            detail=f'Password reset for agent {agent.name} (username: {agent.username})', 
-            created_by=current_user.id
-        ))
-        db.session.commit()
+        audit.record(
+            'reset_agent_password',
+            f'Password reset for agent {agent.name} (username: {agent.username})',
+            current_user.id,
+            sync=True,
+        )
+    db.session.commit()
+    identity.invalidate(agent.get_id())
     
     flash(f"🔄 Password reset successful!\n👤 Agent: {agent.name}\n🔑 Username: {agent.username}\n🔐 New Password: {new_password}\n⚠️ Save this password - it will not be shown again!", 'warning')
     return redirect(url_for('agents_list'))
@@ -491,6 +386,31 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config.get('ALLOWED_EXTENSIONS', set())
 
 
+def store_upload(f, filename):
+    """Stream an upload to disk while hashing it; returns (stored_name, size, digest).
+
+    Files are stored content-addressed as <sha256>.<ext>, so identical
+    uploads share one copy and same-named uploads no longer overwrite
+    each other.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    sha = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.part', delete=False) as tmp:
+        for chunk in iter(lambda: f.stream.read(64 * 1024), b''):
+            sha.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+    digest = sha.hexdigest()
+    stored_name = f"{digest}.{filename.rsplit('.', 1)[1].lower()}"
+    path = os.path.join(folder, stored_name)
+    if os.path.exists(path):
+        os.remove(tmp.name)
+    else:
+        os.replace(tmp.name, path)
+    return stored_name, size, digest
+
+
 @app.route('/files/upload', methods=['GET', 'POST'])
 @login_required
 def files_upload():
@@ -498,136 +418,125 @@ def files_upload():
         f = request.files.get('file')
         if f and allowed_file(f.filename):
             filename = secure_filename(f.filename)
-            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            f.save(path)
-            fu = FileUpload(filename=filename, uploaded_by=current_user.id)
-            db.session.add(fu)
-            db.session.add(Log(action='upload_file', detail=f'Uploaded {filename}', created_by=current_user.id))
+            stored_name, size, digest = store_upload(f, filename)
+            path = os.path.join(app.config['UPLOAD_FOLDER'], stored_name)
+            audit.record('upload_file', f'Uploaded {filename}', current_user.id)
+            fu = FileUpload.query.filter_by(digest=digest).first()
+            if fu is not None and ImportJob.query.filter(ImportJob.file_id == fu.id, jobs.active(app)).first():
+                flash(f'{filename} has the same content as {fu.filename}, which was already imported')
+                return redirect(url_for('files_upload'))
+            if fu is None:
+                fu = FileUpload(filename=filename, uploaded_by=current_user.id, stored_name=stored_name, size=size, digest=digest)
+                db.session.add(fu)
+                db.session.flush()
+            # Parse the spreadsheet and import known data in the background
+            job = ImportJob(file_id=fu.id, filename=filename, created_by=current_user.id)
+            db.session.add(job)
             db.session.commit()
-            # Try to parse spreadsheet and import known data
-            try:
-                xls = pd.read_excel(path, sheet_name=None)
-                imported = []
-                for sheet, df in xls.items():
-                    cols_map = {str(c).strip().lower(): c for c in df.columns}
-                    lowered = set(cols_map.keys())
-                    # Agents import
-                    name_keys = ['name', 'nome', 'agent', 'agent_name']
-                    name_col = None
-                    for k in name_keys:
-                        if k in lowered:
-                            name_col = cols_map[k]
-                            break
-                    if name_col:
-                        count = 0
-                        phone_col = cols_map.get('phone') or cols_map.get('telefone')
-                        email_col = cols_map.get('email') or cols_map.get('e-mail')
-                        for _, row in df.iterrows():
-                            name = row.get(name_col)
-                            if not name or str(name).strip() == '':
-                                continue
-                            phone = row.get(phone_col) if phone_col in df.columns else None
-                            email = row.get(email_col) if email_col in df.columns else None
-                            # Auto-create login credentials
-                            base = (str(email).strip().lower() if email and pd.notna(email) else str(name).strip().lower())
-                            base = ''.join(ch if ch.isalnum() else '.' for ch in base)
-                            base = base or f"agent{int(datetime.utcnow().timestamp())}"
-                            username = base
-                            idx = 1
-                            while Agent.query.filter_by(username=username).first():
-                                idx += 1
-                                username = f"{base}.{idx}"
-                            temp_password = secrets.token_urlsafe(8)
-                            agent = Agent(
-                                name=str(name).strip(),
-                                phone=str(phone).strip() if phone and pd.notna(phone) else None,
-                                email=str(email).strip() if email and pd.notna(email) else None,
-                                username=username,
-                                password_hash=generate_password_hash(temp_password)
-                            )
-                            db.session.add(agent)
-                            count += 1
-                        db.session.commit()
-                        imported.append(f'Agents:{count}')
-                    # Purchases import
-                    amt_key = None
-                    if 'amount' in lowered:
-                        amt_key = 'amount'
-                    elif 'valor' in lowered:
-                        amt_key = 'valor'
-                    if amt_key:
-                        agent_key = 'agent_id' if 'agent_id' in lowered else ('agent' if 'agent' in lowered else None)
-                        date_key = 'date' if 'date' in lowered else None
-                        note_key = 'note' if 'note' in lowered else None
-                        count = 0
-                        for _, row in df.iterrows():
-                            amt = row.get(cols_map.get(amt_key))
-                            if not pd.notna(amt):
-                                continue
-                            agent_id = None
-                            if agent_key:
-                                agent_id = row.get(cols_map.get(agent_key))
-                            date_val = None
-                            try:
-                                if date_key and pd.notna(row.get(cols_map.get(date_key))):
-                                    date_val = pd.to_datetime(row.get(cols_map.get(date_key))).date()
-                            except Exception:
-                                date_val = None
-                            p = Purchase(agent_id=int(agent_id) if pd.notna(agent_id) else None, amount=float(amt), note=str(row.get(cols_map.get(note_key)) or ''), date=date_val)
-                            db.session.add(p)
-                            count += 1
-                        db.session.commit()
-                        imported.append(f'Purchases:{count}')
-                    # Income import
-                    if 'amount' in lowered and 'source' in lowered:
-                        count = 0
-                        for _, row in df.iterrows():
-                            amt = row.get(cols_map.get('amount'))
-                            if not pd.notna(amt):
-                                continue
-                            source = row.get(cols_map.get('source'))
-                            date_val = None
-                            try:
-                                if 'date' in cols_map and pd.notna(row.get(cols_map.get('date'))):
-                                    date_val = pd.to_datetime(row.get(cols_map.get('date'))).date()
-                            except Exception:
-                                date_val = None
-                            inc = Income(amount=float(amt), source=str(source) if pd.notna(source) else '', note=str(row.get(cols_map.get('note')) or ''), date=date_val)
-                            db.session.add(inc)
-                            count += 1
-                        db.session.commit()
-                        imported.append(f'Income:{count}')
-                if imported:
-                    db.session.add(Log(action='import_excel', detail=f'Imported: {";".join(imported)} from {filename}', created_by=current_user.id))
-                    db.session.commit()
-            except Exception as e:
-                db.session.add(Log(action='import_error', detail=f'Error importing {filename}: {e}', created_by=current_user.id))
-                db.session.commit()
-            flash('File uploaded')
-            return redirect(url_for('admin_dashboard'))
+            jobs.enqueue(app, job.id, path)
+            flash('File uploaded, import queued')
+            return redirect(url_for('files_upload'))
         flash('Invalid file or no file')
-    return render_template('upload_files.html')
+    jobs.fail_stale(app)
+    jobs.recover_once(app)
+    recent_jobs = ImportJob.query.order_by(ImportJob.id.desc()).limit(10).all()
+    return render_template('upload_files.html', jobs=recent_jobs, admins=Admin.query.order_by(Admin.username).all())
+
+
+@app.route('/files/jobs/<int:job_id>')
+@login_required
+def import_job_status(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    if job.status == 'running' and jobs.fail_stale(app):
+        db.session.refresh(job)
+    return jsonify(job.to_dict())
 
 
 @app.route('/files/download/<int:file_id>')
 @login_required
 def files_download(file_id):
     f = FileUpload.query.get_or_404(file_id)
-    return send_from_directory(app.config['UPLOAD_FOLDER'], f.filename, as_attachment=True)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], f.storage_name, as_attachment=True, download_name=f.filename)
+
+
+# Formats that are already compressed; deflating them again only costs CPU
+STORED_EXTENSIONS = {'xlsx', 'zip'}
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable sink; zipfile writes into it and the response drains it"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, chunk_size=64 * 1024):
+    """Yield a zip archive of [(path, arcname)] piece by piece, holding one chunk at a time"""
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for path, arcname in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname=arcname)
+            ext = arcname.rsplit('.', 1)[-1].lower()
+            info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
 
 
 @app.route('/files/download_all')
 @login_required
 def files_download_all():
-    files = FileUpload.query.all()
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, 'w') as zf:
-        for f in files:
-            path = os.path.join(app.config['UPLOAD_FOLDER'], f.filename)
-            if os.path.exists(path):
-                zf.write(path, arcname=f.filename)
-    mem.seek(0)
-    return send_file(mem, download_name='all_files.zip', as_attachment=True)
+    """Stream the uploaded files as a zip, optionally filtered by upload date and uploader"""
+    query = FileUpload.query
+    from_date = request.args.get('from_date')
+    to_date = request.args.get('to_date')
+    uploaded_by = request.args.get('uploaded_by', type=int)
+    if from_date:
+        try:
+            query = query.filter(FileUpload.uploaded_at >= datetime.strptime(from_date, '%Y-%m-%d'))
+        except ValueError:
+            pass
+    if to_date:
+        try:
+            query = query.filter(FileUpload.uploaded_at < datetime.strptime(to_date, '%Y-%m-%d') + timedelta(days=1))
+        except ValueError:
+            pass
+    if uploaded_by:
+        query = query.filter(FileUpload.uploaded_by == uploaded_by)
+
+    entries, names = [], set()
+    for f in query.order_by(FileUpload.uploaded_at, FileUpload.id):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f.storage_name)
+        if not os.path.exists(path):
+            continue
+        arcname = f.filename
+        if arcname in names:
+            stem, dot, ext = arcname.rpartition('.')
+            arcname = f'{stem}_{f.id}{dot}{ext}' if dot else f'{arcname}_{f.id}'
+        names.add(arcname)
+        entries.append((path, arcname))
+    return Response(
+        stream_zip(entries),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=all_files.zip'},
+    )
 
 
 # Tasks
@@ -650,17 +559,47 @@ def tasks():
         due_date = datetime.strptime(due, '%Y-%m-%d').date() if due else None
         t = Task(title=title, description=description, agent_id=agent_id, due_date=due_date, car_count=car_count)
         db.session.add(t)
-        db.session.add(Log(action='create_task', detail=f'Task {title} assigned to {agent_id}', created_by=current_user.id))
         db.session.commit()
+        audit.record('create_task', f'Task {title} assigned to {agent_id}', current_user.id)
         return redirect(url_for('tasks'))
     
     agents = Agent.query.all()
+    today = datetime.now().date()
     
     # الموظف يرى مهامه فقط، المدير يرى كل المهام
+    scope = []
     if is_agent:
-        tasks_list = Task.query.filter_by(agent_id=current_user.id).order_by(Task.assigned_at.desc()).all()
-    else:
-        tasks_list = Task.query.order_by(Task.assigned_at.desc()).all()
+        scope.append(Task.agent_id == current_user.id)
+    elif request.args.get('agent_id', type=int):
+        scope.append(Task.agent_id == request.args.get('agent_id', type=int))
+    
+    # Filters; the list is paged newest first on (assigned_at, id)
+    criteria = list(scope)
+    status = request.args.get('status')
+    if status == 'open':
+        criteria.append(Task.completed == False)
+    elif status == 'completed':
+        criteria.append(Task.completed == True)
+    elif status == 'overdue':
+        criteria += [Task.completed == False, Task.due_date < today]
+    try:
+        if request.args.get('due_from'):
+            criteria.append(Task.due_date >= datetime.strptime(request.args['due_from'], '%Y-%m-%d').date())
+        if request.args.get('due_to'):
+            criteria.append(Task.due_date <= datetime.strptime(request.args['due_to'], '%Y-%m-%d').date())
+    except ValueError:
+        pass
+    per_page = app.config.get('TASKS_PER_PAGE', 50)
+    page = keyset_page(Task.query.options(agent_load(Task)).filter(*criteria), (Task.assigned_at, Task.id), per_page,
+                       before=request.args.get('before'), after=request.args.get('after'))
+    tasks_list = page['items']
+    filters = {k: v for k, v in request.args.items() if k not in ('before', 'after') and v}
+    
+    # Open and overdue counts in one aggregate over the open tasks only
+    open_count, overdue_count = db.session.query(
+        db.func.count(Task.id), db.func.count(db.case((Task.due_date < today, 1)))
+    ).filter(Task.completed == False, *scope).one()
+    counts = {'open': open_count, 'overdue': overdue_count}
     
     # Get current month/year for monthly targets
     from models import MonthlyTarget
@@ -669,22 +608,13 @@ def tasks():
     current_year = current_date.year
     
     # Calculate monthly progress for each agent
+    targets = {t.agent_id: t for t in MonthlyTarget.query.filter_by(year=current_year, month=current_month)}
+    month_rows = month_rollups(current_year, current_month)
     monthly_stats = {}
     for agent in agents:
-        # Get target for current month
-        target = MonthlyTarget.query.filter_by(
-            agent_id=agent.id, 
-            year=current_year, 
-            month=current_month
-        ).first()
-        
-        # Calculate completed tasks cars this month
-        completed_cars = db.session.query(db.func.sum(Task.car_count)).filter(
-            Task.agent_id == agent.id,
-            Task.completed == True,
-            db.func.strftime('%Y', Task.completed_at) == str(current_year),
-            db.func.strftime('%m', Task.completed_at) == str(current_month).zfill(2)
-        ).scalar() or 0
+        target = targets.get(agent.id)
+        rollup = month_rows.get(agent.id)
+        completed_cars = rollup.cars_wrapped if rollup else 0
         
         monthly_stats[agent.id] = {
             'target': target.target_cars if target else 0,
@@ -695,28 +625,18 @@ def tasks():
     # Calculate agent statistics for agents
     agent_stats = {}
     if is_agent:
-        # Total completed tasks
-        total_completed = Task.query.filter_by(agent_id=current_user.id, completed=True).count()
-        # Total cars wrapped
-        total_cars = db.session.query(db.func.sum(Task.car_count)).filter(
-            Task.agent_id == current_user.id,
-            Task.completed == True
-        ).scalar() or 0
-        # Completed this month
-        completed_this_month = Task.query.filter(
-            Task.agent_id == current_user.id,
-            Task.completed == True,
-            db.func.strftime('%Y', Task.completed_at) == str(current_year),
-            db.func.strftime('%m', Task.completed_at) == str(current_month).zfill(2)
-        ).count()
-        # Open tasks
-        open_tasks = Task.query.filter_by(agent_id=current_user.id, completed=False).count()
+        # Lifetime totals from this agent's rollup rows only
+        total_completed, total_cars = db.session.query(
+            db.func.coalesce(db.func.sum(AgentMonthRollup.tasks_completed), 0),
+            db.func.coalesce(db.func.sum(AgentMonthRollup.cars_wrapped), 0),
+        ).filter(AgentMonthRollup.agent_id == current_user.id).one()
+        rollup = month_rows.get(current_user.id)
         
         agent_stats = {
             'total_completed': total_completed,
             'total_cars': total_cars,
-            'completed_this_month': completed_this_month,
-            'open_tasks': open_tasks,
+            'completed_this_month': rollup.tasks_completed if rollup else 0,
+            'open_tasks': counts['open'],
             'target': monthly_stats[current_user.id]['target'] if current_user.id in monthly_stats else 0,
             'achieved_cars': monthly_stats[current_user.id]['achieved'] if current_user.id in monthly_stats else 0,
             'percentage': monthly_stats[current_user.id]['percentage'] if current_user.id in monthly_stats else 0
@@ -724,7 +644,7 @@ def tasks():
     
     return render_template('tasks.html', agents=agents, tasks=tasks_list, is_agent=is_agent, 
                          monthly_stats=monthly_stats, current_month=current_month, current_year=current_year, 
-                         agent_stats=agent_stats, today=datetime.now().date())
+                         agent_stats=agent_stats, today=today, page=page, filters=filters, counts=counts)
 
 
 @app.route('/tasks/<int:task_id>/edit', methods=['GET', 'POST'])
@@ -744,8 +664,9 @@ def edit_task(task_id):
         due = request.form.get('due_date')
         task.due_date = datetime.strptime(due, '%Y-%m-%d').date() if due else None
         
-        db.session.add(Log(action='edit_task', detail=f'Task {task.title} updated', created_by=current_user.id))
+        detail = f'Task {task.title} updated'
         db.session.commit()
+        audit.record('edit_task', detail, current_user.id)
         flash('Task updated successfully!', 'success')
         return redirect(url_for('tasks'))
     
@@ -764,8 +685,8 @@ def delete_task(task_id):
     title = task.title
     
     db.session.delete(task)
-    db.session.add(Log(action='delete_task', detail=f'Task {title} deleted', created_by=current_user.id))
     db.session.commit()
+    audit.record('delete_task', f'Task {title} deleted', current_user.id)
     flash(f'Task "{title}" deleted successfully!', 'success')
     return redirect(url_for('tasks'))
 
@@ -783,8 +704,9 @@ def complete_task(task_id):
     task.completed = True
     task.completed_at = datetime.utcnow()
     
-    db.session.add(Log(action='complete_task', detail=f'Task {task.title} completed by {current_user.name if hasattr(current_user, "name") else "admin"}', created_by=current_user.id))
+    detail = f'Task {task.title} completed by {current_user.name if hasattr(current_user, "name") else "admin"}'
     db.session.commit()
+    audit.record('complete_task', detail, current_user.id)
     flash('تم إكمال المهمة بنجاح!', 'success')
     return redirect(url_for('tasks'))
 
@@ -810,8 +732,9 @@ def toggle_task_status(task_id):
         action = 'completed'
         flash('تم إكمال المهمة بنجاح!', 'success')
     
-    db.session.add(Log(action=f'{action}_task', detail=f'Task {task.title} {action} by {current_user.name if hasattr(current_user, "name") else "admin"}', created_by=current_user.id))
+    detail = f'Task {task.title} {action} by {current_user.name if hasattr(current_user, "name") else "admin"}'
     db.session.commit()
+    audit.record(f'{action}_task', detail, current_user.id)
     return redirect(url_for('tasks'))
 
 
@@ -840,8 +763,8 @@ def quick_add_task():
     )
     
     db.session.add(task)
-    db.session.add(Log(action='quick_add_task', detail=f'Quick task: {title} for agent {agent_id} with {car_count} cars', created_by=current_user.id))
     db.session.commit()
+    audit.record('quick_add_task', f'Quick task: {title} for agent {agent_id} with {car_count} cars', current_user.id)
     
     flash(f'تمت إضافة المهمة: {car_count} سيارة مغلفة', 'success')
     return redirect(url_for('tasks'))
@@ -889,7 +812,7 @@ def monthly_targets():
         return redirect(url_for('monthly_targets'))
     
     agents = Agent.query.all()
-    targets = MonthlyTarget.query.order_by(MonthlyTarget.year.desc(), MonthlyTarget.month.desc()).all()
+    targets = MonthlyTarget.query.options(agent_load(MonthlyTarget)).order_by(MonthlyTarget.year.desc(), MonthlyTarget.month.desc()).all()
     
     return render_template('monthly_targets.html', agents=agents, targets=targets, is_agent=is_agent)
 
@@ -930,8 +853,8 @@ def leader():
         date_obj = datetime.strptime(date, '%Y-%m-%d').date() if date else datetime.utcnow().date()
         p = Purchase(agent_id=agent_id, amount=amount, note=note, date=date_obj)
         db.session.add(p)
-        db.session.add(Log(action='add_purchase', detail=f'Purchase {amount} by agent {agent_id}', created_by=current_user.id))
         db.session.commit()
+        audit.record('add_purchase', f'Purchase {amount} by agent {agent_id}', current_user.id)
         return redirect(url_for('leader'))
     
     agents = Agent.query.all()
@@ -941,11 +864,13 @@ def leader():
     current_agent_id = current_user.id if is_agent else None
     
     # Handle search & filter
-    query = Purchase.query
+    filters = []
     
     # إذا كان موظف، عرض مشترياته فقط
     if is_agent:
-        query = query.filter(Purchase.agent_id == current_agent_id)
+        filters.append(Purchase.agent_id == current_agent_id)
+    agent_ids = [current_agent_id] if is_agent else []
+    dated = False
     
     from_date = request.args.get('from_date')
     to_date = request.args.get('to_date')
@@ -954,21 +879,22 @@ def leader():
     if from_date:
         try:
             from_date_obj = datetime.strptime(from_date, '%Y-%m-%d').date()
-            query = query.filter(Purchase.date >= from_date_obj)
+            filters.append(Purchase.date >= from_date_obj)
+            dated = True
         except:
             pass
     
     if to_date:
         try:
             to_date_obj = datetime.strptime(to_date, '%Y-%m-%d').date()
-            query = query.filter(Purchase.date <= to_date_obj)
+            filters.append(Purchase.date <= to_date_obj)
+            dated = True
         except:
             pass
     
     if agent_filter:
-        query = query.filter(Purchase.agent_id == int(agent_filter))
-    
-    purchases = query.order_by(Purchase.date.desc()).limit(50).all()
+        filters.append(Purchase.agent_id == int(agent_filter))
+        agent_ids.append(int(agent_filter))
     
     # Calculate total expenses for agent
     total_agent_expenses = 0
@@ -977,65 +903,58 @@ def leader():
             Purchase.agent_id == current_agent_id
         ).scalar() or 0
     
-    # Group purchases by month and agent
-    from collections import defaultdict
-    purchases_by_month = defaultdict(lambda: {'purchases': [], 'total': 0, 'by_agent': defaultdict(lambda: {'purchases': [], 'total': 0})})
-    
-    # Get all purchases for grouping (not limited)
-    all_purchases_query = Purchase.query
-    if is_agent:
-        all_purchases_query = all_purchases_query.filter(Purchase.agent_id == current_agent_id)
+    # monthly totals for chart (kept for compatibility); the rollups hold
+    # them per agent and month, so only a date range needs the ledger
+    if dated:
+        monthly = monthly_series(Purchase, *filters)
+    else:
+        monthly = rollup_series('purchase', *(AgentMonthRollup.agent_id == a for a in agent_ids))
     
-    all_purchases = all_purchases_query.order_by(Purchase.date.desc()).all()
+    # Months are paginated newest first; only the visible ones are expanded
+    per_page = app.config.get('LEADER_MONTHS_PER_PAGE', 3)
+    page = max(request.args.get('page', 1, type=int), 1)
+    visible = list(reversed(monthly))[(page - 1) * per_page:page * per_page]
+    has_next = len(monthly) > page * per_page
     
-    for p in all_purchases:
-        if p.date:
-            month_key = p.date.strftime('%Y-%m')
-            month_display = p.date.strftime('%B %Y')  # e.g., "January 2026"
-            
-            # Add to month total
-            purchases_by_month[month_key]['month_display'] = month_display
-            purchases_by_month[month_key]['month_key'] = month_key
-            purchases_by_month[month_key]['purchases'].append(p)
-            purchases_by_month[month_key]['total'] += p.amount
-            
-            # Add to agent total within month
-            if p.agent_id:
-                agent = Agent.query.get(p.agent_id)
-                agent_name = agent.name if agent else 'N/A'
-                purchases_by_month[month_key]['by_agent'][p.agent_id]['name'] = agent_name
-                purchases_by_month[month_key]['by_agent'][p.agent_id]['purchases'].append(p)
-                purchases_by_month[month_key]['by_agent'][p.agent_id]['total'] += p.amount
-    
-    # Convert to sorted list (newest first)
     purchases_by_month_list = []
-    for month_key in sorted(purchases_by_month.keys(), reverse=True):
-        month_data = purchases_by_month[month_key]
-        # Convert by_agent defaultdict to regular dict
-        month_data['by_agent'] = dict(month_data['by_agent'])
-        purchases_by_month_list.append(month_data)
-    
-    # monthly totals for chart (kept for compatibility)
-    try:
-        with db.engine.connect() as conn:
-            df = pd.read_sql(str(Purchase.query.statement.compile(compile_kwargs={"literal_binds": True})), conn)
-        if not df.empty:
-            df['date'] = pd.to_datetime(df['date'])
-            df['month'] = df['date'].dt.to_period('M')
-            monthly = df.groupby('month')['amount'].sum().reset_index()
-            monthly['month'] = monthly['month'].astype(str)
-            monthly = monthly.to_dict(orient='records')
-        else:
-            monthly = []
-    except Exception as e:
-        print(f"Error in leader monthly totals: {e}")
-        monthly = []
+    if visible:
+        in_range = filters + month_range(Purchase.date, visible[-1]['month'], visible[0]['month'])
+        months = {}
+        for m in visible:
+            months[m['month']] = {
+                'month_key': m['month'],
+                'month_display': datetime.strptime(m['month'], '%Y-%m').strftime('%B %Y'),
+                'total': m['amount'],
+                'count': 0,
+                'by_agent': {},
+                'purchases': [],
+            }
+            purchases_by_month_list.append(months[m['month']])
+        
+        # Month/agent totals in one grouped query
+        month_col = db.func.strftime('%Y-%m', Purchase.date)
+        grouped = db.session.query(
+            month_col, Purchase.agent_id, Agent.name,
+            db.func.sum(Purchase.amount), db.func.count(Purchase.id)
+        ).outerjoin(Agent, Agent.id == Purchase.agent_id).filter(*in_range).group_by(
+            month_col, Purchase.agent_id, Agent.name
+        )
+        for month_key, agent_id, agent_name, total, count in grouped:
+            months[month_key]['count'] += count
+            if agent_id:
+                months[month_key]['by_agent'][agent_id] = {'name': agent_name or 'N/A', 'total': total or 0, 'count': count}
+        
+        # Visible purchases with their agents
+        rows = Purchase.query.options(agent_load(Purchase)).filter(*in_range).order_by(Purchase.date.desc(), Purchase.id.desc())
+        for p in rows:
+            months[p.date.strftime('%Y-%m')]['purchases'].append(p)
     
     return render_template('leader.html', 
                           agents=agents, 
-                          purchases=purchases, 
                           monthly=monthly, 
                           purchases_by_month=purchases_by_month_list,
+                          page=page,
+                          has_next=has_next,
                           is_agent=is_agent, 
                           current_agent_id=current_agent_id, 
                           total_agent_expenses=total_agent_expenses)
@@ -1047,22 +966,21 @@ def leader_download_month(month):
     """Download purchases for specific month as Excel"""
     try:
         # month format: '2025-01' or similar
-        purchases = Purchase.query.all()
+        purchases = Purchase.query.options(joinedload(Purchase.agent)).filter(*month_range(Purchase.date, month)).order_by(Purchase.date).all()
         data = []
         for p in purchases:
-            if p.date and p.date.strftime('%Y-%m') == month:
-                agent = Agent.query.get(p.agent_id) if p.agent_id else None
-                data.append({
-                    'Date': p.date.strftime('%Y-%m-%d'),
-                    'Agent': agent.name if agent else 'N/A',
-                    'Amount': p.amount,
-                    'Note': p.note or ''
-                })
+            data.append({
+                'Date': p.date.strftime('%Y-%m-%d'),
+                'Agent': p.agent.name if p.agent else 'N/A',
+                'Amount': p.amount,
+                'Note': p.note or ''
+            })
         
         if not data:
             flash('No purchases found for this month')
             return redirect(url_for('leader'))
         
+        import pandas as pd
         df = pd.DataFrame(data)
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -1070,8 +988,7 @@ def leader_download_month(month):
         output.seek(0)
         
         if isinstance(current_user, Admin):
-            db.session.add(Log(action='download_purchases', detail=f'Downloaded purchases for {month}', created_by=current_user.id))
-            db.session.commit()
+            audit.record('download_purchases', f'Downloaded purchases for {month}', current_user.id)
         
         return send_file(output, download_name=f'purchases_{month}.xlsx', as_attachment=True)
     except Exception as e:
@@ -1094,8 +1011,8 @@ def delete_purchase(purchase_id):
     note = purchase.note
     
     db.session.delete(purchase)
-    db.session.add(Log(action='delete_purchase', detail=f'Purchase {amount} deleted: {note}', created_by=current_user.id))
     db.session.commit()
+    audit.record('delete_purchase', f'Purchase {amount} deleted: {note}', current_user.id)
     
     flash(f'تم حذف المصروف بنجاح ({amount} درهم)', 'success')
     return redirect(url_for('leader'))
@@ -1121,8 +1038,9 @@ def edit_purchase(purchase_id):
         if date_str:
             purchase.date = datetime.strptime(date_str, '%Y-%m-%d').date()
         
-        db.session.add(Log(action='edit_purchase', detail=f'Purchase {purchase.id} updated', created_by=current_user.id))
+        detail = f'Purchase {purchase.id} updated'
         db.session.commit()
+        audit.record('edit_purchase', detail, current_user.id)
         
         flash('تم تحديث المصروف بنجاح', 'success')
         return redirect(url_for('leader'))
@@ -1151,9 +1069,7 @@ def income():
         date = request.form.get('date')
         date_obj = datetime.strptime(date, '%Y-%m-%d').date() if date else datetime.utcnow().date()
         
-        # Generate invoice number
-        from datetime import datetime as dt
-        invoice_number = f"INV-{dt.now().strftime('%Y%m%d%H%M%S')}-{agent_id}"
+        invoice_number = invoices.next_number()
         
         inc = Income(
             agent_id=agent_id, 
@@ -1168,19 +1084,9 @@ def income():
         )
         db.session.add(inc)
         
-        # Add service type to list if new
-        if service_type and service_type.strip():
-            existing = ServiceType.query.filter_by(name=service_type.strip()).first()
-            if not existing:
-                new_service = ServiceType(name=service_type.strip())
-                db.session.add(new_service)
-        
-        # Add car type to list if new
-        if car_type and car_type.strip():
-            existing_car = CarType.query.filter_by(name=car_type.strip()).first()
-            if not existing_car:
-                new_car = CarType(name=car_type.strip())
-                db.session.add(new_car)
+        # Add service / car type to the lists if new
+        added_service = catalog.add(ServiceType, service_type)
+        added_car = catalog.add(CarType, car_type)
         
         # Create task for this income (car wrapping)
         task_title = f"تغليف: {service_type or 'N/A'} - {customer_name or 'N/A'}"
@@ -1196,26 +1102,28 @@ def income():
         db.session.flush()  # Get inc.id
         task.income_id = inc.id
         
-        db.session.add(Log(action='add_income', detail=f'Income {amount} from {customer_name} - {service_type} - {car_type}', created_by=current_user.id))
         db.session.commit()
+        if added_service or added_car:
+            catalog.invalidate()
+        audit.record('add_income', f'Income {amount} from {customer_name} - {service_type} - {car_type}', current_user.id)
         
         flash(f'تمت إضافة الخدمة بنجاح! ✅ رقم الفاتورة: {invoice_number}', 'success')
         return redirect(url_for('income'))
     
     agents = Agent.query.all()
-    service_types = ServiceType.query.order_by(ServiceType.name).all()
-    car_types = CarType.query.order_by(CarType.name).all()
+    service_types = catalog.names(ServiceType)
+    car_types = catalog.names(CarType)
     
     # إذا كان الموظف، عرض مداخيله فقط
     is_agent = isinstance(current_user, Agent)
     current_agent_id = current_user.id if is_agent else None
     
     # Handle search & filter
-    query = Income.query
+    filters = []
     
     # إذا كان موظف، عرض مداخيله فقط
     if is_agent:
-        query = query.filter(Income.agent_id == current_agent_id)
+        filters.append(Income.agent_id == current_agent_id)
     
     from_date = request.args.get('from_date')
     to_date = request.args.get('to_date')
@@ -1225,60 +1133,89 @@ def income():
     if from_date:
         try:
             from_date_obj = datetime.strptime(from_date, '%Y-%m-%d').date()
-            query = query.filter(Income.date >= from_date_obj)
+            filters.append(Income.date >= from_date_obj)
         except:
             pass
     
     if to_date:
         try:
             to_date_obj = datetime.strptime(to_date, '%Y-%m-%d').date()
-            query = query.filter(Income.date <= to_date_obj)
+            filters.append(Income.date <= to_date_obj)
         except:
             pass
     
     if source_filter:
-        query = query.filter(Income.source.ilike(f'%{source_filter}%'))
+        filters.append(Income.source.ilike(f'%{source_filter}%'))
     
     if agent_filter and not is_agent:
-        query = query.filter(Income.agent_id == int(agent_filter))
+        filters.append(Income.agent_id == int(agent_filter))
     
+    query = Income.query.options(agent_load(Income)).filter(*filters)
     incomes = query.order_by(Income.date.desc()).limit(50).all()
     
-    # Monthly totals - filter by agent if needed
-    if is_agent:
-        monthly_query = Income.query.filter_by(agent_id=current_agent_id)
-    else:
-        monthly_query = Income.query
-    
-    try:
-        with db.engine.connect() as conn:
-            df = pd.read_sql(str(monthly_query.statement.compile(compile_kwargs={"literal_binds": True})), conn)
-        if not df.empty:
-            df['date'] = pd.to_datetime(df['date'])
-            df['month'] = df['date'].dt.to_period('M')
-            monthly = df.groupby('month')['amount'].sum().reset_index()
-            monthly['month'] = monthly['month'].astype(str)
-            monthly = monthly.to_dict(orient='records')
-        else:
-            monthly = []
-    except Exception as e:
-        print(f"Error in income monthly totals: {e}")
-        monthly = []
+    # Monthly totals, grouped in the database with the same filters
+    monthly = monthly_series(Income, *filters)
     return render_template('income.html', incomes=incomes, monthly=monthly, agents=agents, service_types=service_types, car_types=car_types, is_agent=is_agent, current_agent_id=current_agent_id)
 
 
 @app.route('/income/<int:income_id>/invoice')
 @login_required
 def generate_invoice(income_id):
-    income = Income.query.get_or_404(income_id)
-    agent = Agent.query.get(income.agent_id)
+    rows = invoice_export.rows([Income.id == income_id])
+    if not rows:
+        abort(404)
     
     # Check permission
-    if isinstance(current_user, Agent) and current_user.id != income.agent_id:
+    if isinstance(current_user, Agent) and current_user.id != rows[0]['agent_id']:
         flash('غير مسموح بالوصول لهذه الفاتورة', 'danger')
         return redirect(url_for('income'))
     
-    return render_template('invoice.html', income=income, agent=agent)
+    _, path = next(invoice_export.rendered(rows))
+    return send_file(path, mimetype='text/html')
+
+
+@app.route('/income/invoices')
+@login_required
+def income_invoices():
+    """Every invoice of a month (``month``), agent and/or date range as a zip, or with format=html as one printable page"""
+    filters, label = [], []
+    try:
+        month = request.args.get('month')
+        if month:
+            filters += month_range(Income.date, month)
+            label.append(month)
+        from_date = request.args.get('from_date')
+        if from_date:
+            filters.append(Income.date >= datetime.strptime(from_date, '%Y-%m-%d').date())
+            label.append(f'from_{from_date}')
+        to_date = request.args.get('to_date')
+        if to_date:
+            filters.append(Income.date <= datetime.strptime(to_date, '%Y-%m-%d').date())
+            label.append(f'to_{to_date}')
+    except ValueError:
+        flash('Invalid date', 'danger')
+        return redirect(url_for('income'))
+    agent_id = current_user.id if isinstance(current_user, Agent) else request.args.get('agent_id', type=int)
+    if agent_id:
+        filters.append(Income.agent_id == agent_id)
+        label.append(f'agent_{agent_id}')
+    if not filters:
+        flash('اختر شهرًا أو فترة أو موظفًا', 'warning')
+        return redirect(url_for('income'))
+
+    rows = invoice_export.rows(filters)
+    if not rows:
+        flash('No invoices found')
+        return redirect(url_for('income'))
+    name = 'invoices_' + '_'.join(label)
+    if isinstance(current_user, Admin):
+        audit.record('download_invoices', f'Downloaded {len(rows)} invoices ({name})', current_user.id)
+
+    if request.args.get('format') == 'html':
+        return Response(invoice_export.printable(rows, name), mimetype='text/html')
+    entries = ((path, secure_filename(f"{row['invoice_number'] or row['id']}.html")) for row, path in invoice_export.rendered(rows))
+    return Response(stream_zip(entries), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={name}.zip'})
 
 @app.route('/income/<int:income_id>/delete', methods=['POST'])
 @login_required
@@ -1295,9 +1232,9 @@ def delete_income(income_id):
     if task:
         db.session.delete(task)
     
-    db.session.add(Log(action='delete_income', detail=f'Deleted income {income.invoice_number} - Amount: {income.amount} MAD', created_by=current_user.id))
     db.session.delete(income)
     db.session.commit()
+    audit.record('delete_income', f'Deleted income {income.invoice_number} - Amount: {income.amount} MAD', current_user.id)
     flash('تم حذف المدخول بنجاح!', 'success')
     return redirect(url_for('income'))
 
@@ -1333,13 +1270,14 @@ def edit_income(income_id):
             task.agent_id = income.agent_id
             task.due_date = income.date
         
-        db.session.add(Log(action='edit_income', detail=f'Edited income {income.invoice_number}', created_by=current_user.id))
+        detail = f'Edited income {income.invoice_number}'
         db.session.commit()
+        audit.record('edit_income', detail, current_user.id)
         flash('تم تحديث المدخول بنجاح!', 'success')
         return redirect(url_for('income'))
     
-    service_types = ServiceType.query.all()
-    car_types = CarType.query.all()
+    service_types = catalog.names(ServiceType)
+    car_types = catalog.names(CarType)
     return render_template('edit_income.html', income=income, agents=agents, service_types=service_types, car_types=car_types)
 
 
@@ -1349,21 +1287,21 @@ def income_download_month(month):
     """Download income for specific month as Excel"""
     try:
         # month format: '2025-01' or similar
-        incomes = Income.query.all()
+        incomes = Income.query.filter(*month_range(Income.date, month)).order_by(Income.date).all()
         data = []
         for i in incomes:
-            if i.date and i.date.strftime('%Y-%m') == month:
-                data.append({
-                    'Date': i.date.strftime('%Y-%m-%d'),
-                    'Amount': i.amount,
-                    'Source': i.source or '',
-                    'Note': i.note or ''
-                })
+            data.append({
+                'Date': i.date.strftime('%Y-%m-%d'),
+                'Amount': i.amount,
+                'Source': i.source or '',
+                'Note': i.note or ''
+            })
         
         if not data:
             flash('No income found for this month')
             return redirect(url_for('income'))
         
+        import pandas as pd
         df = pd.DataFrame(data)
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -1371,8 +1309,7 @@ def income_download_month(month):
         output.seek(0)
         
         if isinstance(current_user, Admin):
-            db.session.add(Log(action='download_income', detail=f'Downloaded income for {month}', created_by=current_user.id))
-            db.session.commit()
+            audit.record('download_income', f'Downloaded income for {month}', current_user.id)
         
         return send_file(output, download_name=f'income_{month}.xlsx', as_attachment=True)
     except Exception as e:
@@ -1387,12 +1324,53 @@ def logs():
     if request.method == 'POST':
         action = request.form.get('action')
         detail = request.form.get('detail')
-        l = Log(action=action, detail=detail, created_by=current_user.id)
-        db.session.add(l)
+        audit.record(action, detail, current_user.id, sync=True)
         db.session.commit()
         return redirect(url_for('logs'))
-    logs = Log.query.order_by(Log.created_at.desc()).all()
-    return render_template('logs.html', logs=logs)
+    # Show entries still waiting in the audit queue too
+    audit.flush()
+    action = request.args.get('action', '').strip()
+    user_id = request.args.get('user_id', type=int)
+    start = end = None
+    try:
+        if request.args.get('from_date'):
+            start = datetime.strptime(request.args['from_date'], '%Y-%m-%d')
+    except ValueError:
+        pass
+    try:
+        if request.args.get('to_date'):
+            end = datetime.strptime(request.args['to_date'], '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        pass
+    per_page = app.config.get('LOGS_PER_PAGE', 50)
+    before, after = request.args.get('before'), request.args.get('after')
+
+    months = log_archive.archived_months(app)
+    month = request.args.get('month')
+    if month in months:
+        # Archived month: filter the decompressed file in memory
+        rows = [
+            r for r in log_archive.read_month(app, month)
+            if (not action or r['action'] == action)
+            and (not user_id or r['created_by'] == user_id)
+            and (start is None or r['created_at'] >= start)
+            and (end is None or r['created_at'] < end)
+        ]
+        page = list_page(rows, ('created_at', 'id'), per_page, before, after)
+    else:
+        query = Log.query
+        if action:
+            query = query.filter(Log.action == action)
+        if user_id:
+            query = query.filter(Log.created_by == user_id)
+        if start:
+            query = query.filter(Log.created_at >= start)
+        if end:
+            query = query.filter(Log.created_at < end)
+        page = keyset_page(query, (Log.created_at, Log.id), per_page, before=before, after=after)
+    filters = {k: v for k, v in request.args.items() if k not in ('before', 'after') and v}
+    admins = Admin.query.order_by(Admin.username).all()
+    return render_template('logs.html', logs=page['items'], page=page, filters=filters, admins=admins, archived_months=months)
 
 
 @app.route('/logs/<int:log_id>/delete', methods=['POST'])
@@ -1420,10 +1398,23 @@ def settings():
             shutil.copy(db_path, backup_path)
             
             if isinstance(current_user, Admin):
-                db.session.add(Log(action='backup_database', detail=f'Created backup: {backup_name}', created_by=current_user.id))
+                audit.record('backup_database', f'Created backup: {backup_name}', current_user.id, sync=True)
                 db.session.commit()
             
             return send_file(backup_path, download_name=backup_name, as_attachment=True)
+
+        if action == 'archive_logs':
+            audit.flush()
+            moved = log_archive.archive_logs(app)
+            audit.record('archive_logs', f'Archived {moved} log entries', current_user.id)
+            flash(f'تمت أرشفة {moved} سجل', 'success')
+            return redirect(url_for('settings'))
+
+        if action == 'prune_changes':
+            removed = changes.prune(app)
+            audit.record('prune_changes', f'Pruned {removed} change entries', current_user.id)
+            flash(f'تم حذف {removed} من سجل التغييرات', 'success')
+            return redirect(url_for('settings'))
     
     # Get database size
     db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
@@ -1439,7 +1430,8 @@ def settings():
         'files': FileUpload.query.count()
     }
     
-    return render_template('settings.html', db_size=db_size, counts=counts)
+    return render_template('settings.html', db_size=db_size, counts=counts, retention_days=app.config.get('LOG_RETENTION_DAYS', 180),
+                           user_cache=identity.hit_rate(), change_retention_days=app.config.get('CHANGE_RETENTION_DAYS', 30))
 
 
 @app.route('/change_password', methods=['GET','POST'])
@@ -1449,16 +1441,18 @@ def change_password():
         current = request.form.get('current')
         new = request.form.get('new')
         confirm = request.form.get('confirm')
-        if not check_password_hash(current_user.password_hash, current):
+        # current_user is a cached copy without the hash; load the row to update it
+        user = db.session.get(current_user.__class__, current_user.id)
+        if not check_password_hash(user.password_hash, current):
             flash('Current password incorrect')
             return redirect(url_for('change_password'))
         if new != confirm:
             flash('New passwords do not match')
             return redirect(url_for('change_password'))
-        current_user.password_hash = generate_password_hash(new)
-        db.session.commit()
-        db.session.add(Log(action='change_password', detail=f'Password changed for admin {current_user.username}', created_by=current_user.id))
+        user.password_hash = generate_password_hash(new)
+        audit.record('change_password', f'Password changed for admin {user.username}', user.id, sync=True)
         db.session.commit()
+        identity.invalidate(user.get_id())
         flash('Password changed')
         return redirect(url_for('admin_dashboard'))
     return render_template('change_password.html')
@@ -1467,12 +1461,13 @@ def change_password():
 @app.route('/api_tokens', methods=['GET','POST'])
 @login_required
 def api_tokens():
+    api_auth.flush_usage()
     tokens = APIToken.query.order_by(APIToken.created_at.desc()).all()
     show = None
     if request.method == 'POST':
         name = request.form.get('name') or 'token'
         tval = secrets.token_hex(24)
-        token = APIToken(name=name, token=tval, created_by=current_user.id)
+        token = APIToken(name=name, token_digest=api_auth.digest(tval), created_by=current_user.id)
         db.session.add(token)
         db.session.commit()
         # show the newly created token one time
@@ -1480,13 +1475,15 @@ def api_tokens():
         # mark show_token only for newest
         out = []
         for t in tokens:
-            d = {'id':t.id,'name':t.name,'token':t.token if t.id==token.id else '','created_at':t.created_at,'revoked':t.revoked,'show_token': t.id==token.id}
+            d = {'id':t.id,'name':t.name,'token':tval if t.id==token.id else '','created_at':t.created_at,'revoked':t.revoked,'show_token': t.id==token.id,
+                 'use_count':t.use_count or 0,'last_used_at':t.last_used_at}
             out.append(d)
         return render_template('api_tokens.html', tokens=out)
     # GET
     out = []
     for t in tokens:
-        out.append({'id':t.id,'name':t.name,'token':'','created_at':t.created_at,'revoked':t.revoked,'show_token':False})
+        out.append({'id':t.id,'name':t.name,'token':'','created_at':t.created_at,'revoked':t.revoked,'show_token':False,
+                    'use_count':t.use_count or 0,'last_used_at':t.last_used_at})
     return render_template('api_tokens.html', tokens=out)
 
 
@@ -1495,18 +1492,105 @@ def api_tokens():
 def api_token_revoke(token_id):
     t = APIToken.query.get_or_404(token_id)
     t.revoked = True
+    audit.record('revoke_token', f'Revoked token {t.id}', current_user.id, sync=True)
     db.session.commit()
-    db.session.add(Log(action='revoke_token', detail=f'Revoked token {t.id}', created_by=current_user.id))
-    db.session.commit()
+    api_auth.invalidate()
     return redirect(url_for('api_tokens'))
 
 # --- Simple JSON API endpoints ---
+# Fields each API listing can return (``fields=`` parameter) and the default selection
+AGENT_API_FIELDS = ('id', 'name', 'phone', 'email', 'username', 'is_active', 'created_at', 'updated_at')
+AGENT_API_DEFAULT = ('id', 'name', 'phone', 'email')
+TASK_API_FIELDS = ('id', 'title', 'description', 'agent_id', 'due_date', 'completed', 'completed_at',
+                   'car_count', 'income_id', 'assigned_at', 'updated_at')
+TASK_API_DEFAULT = ('id', 'title', 'agent_id', 'due_date')
+
+
+class APIError(ValueError):
+    pass
+
+
+def _api_arg(name, parse):
+    value = request.args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        raise APIError(f'invalid {name}: {value}')
+
+
+def _api_bool(value):
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(value)
+
+
+def _api_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _api_list(model, allowed, default, filters):
+    """Cursor-paginated, conditional JSON listing of ``model``.
+
+    The body is a JSON array ordered by id; the next page is advertised in
+    a ``Link: <...>; rel="next"`` header (``cursor`` = last id). ETag and
+    Last-Modified come from count(*) and max(updated_at) over the filtered
+    rows, so an unchanged poll is answered 304 from one aggregate query.
+    """
+    names = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(default)
+    unknown = [n for n in names if n not in allowed]
+    if unknown:
+        raise APIError(f"unknown fields: {', '.join(unknown)}")
+    updated_since = _api_arg('updated_since', datetime.fromisoformat)
+    if updated_since:
+        filters.append(model.updated_at >= updated_since)
+
+    count, last_modified = db.session.query(db.func.count(model.id), db.func.max(model.updated_at)).filter(*filters).one()
+    etag = hashlib.sha1(f'{model.__tablename__}:{count}:{last_modified}'.encode()).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    limit = _api_arg('limit', int) or app.config.get('API_PAGE_SIZE', 100)
+    limit = min(max(limit, 1), app.config.get('API_MAX_PAGE_SIZE', 1000))
+    cursor = _api_arg('cursor', int)
+    query = db.session.query(model.id, *(getattr(model, n) for n in names)).filter(*filters)
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    response = jsonify([{n: _json_value(v) for n, v in zip(names, row[1:])} for row in rows[:limit]])
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if len(rows) > limit:
+        next_url = url_for(request.endpoint, _external=True, **dict(request.args, cursor=rows[limit - 1].id))
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+
+@app.errorhandler(APIError)
+def api_error(e):
+    return jsonify({'error': str(e)}), 400
+
+
 @app.route('/api/agents', methods=['GET','POST'])
-@login_required
+@api_auth.api_auth_required
 def api_agents():
     if request.method == 'GET':
-        agents = Agent.query.all()
-        return jsonify([{'id':a.id,'name':a.name,'phone':a.phone,'email':a.email} for a in agents])
+        filters = []
+        active = _api_arg('active', _api_bool)
+        if active is not None:
+            filters.append(Agent.is_active == active)
+        return _api_list(Agent, AGENT_API_FIELDS, AGENT_API_DEFAULT, filters)
     data = request.get_json() or {}
     name = data.get('name')
     if not name:
@@ -1517,13 +1601,53 @@ def api_agents():
     return jsonify({'id':a.id,'name':a.name}), 201
 
 @app.route('/api/tasks', methods=['GET'])
-@login_required
+@api_auth.api_auth_required
 def api_tasks():
-    tasks = Task.query.all()
-    return jsonify([{'id':t.id,'title':t.title,'agent_id':t.agent_id,'due_date':str(t.due_date)} for t in tasks])
+    """Filters: agent_id, completed, due_from / due_to (YYYY-MM-DD), updated_since (ISO datetime)"""
+    filters = []
+    agent_id = _api_arg('agent_id', int)
+    if agent_id is not None:
+        filters.append(Task.agent_id == agent_id)
+    completed = _api_arg('completed', _api_bool)
+    if completed is not None:
+        filters.append(Task.completed == completed)
+    due_from = _api_arg('due_from', _api_date)
+    if due_from:
+        filters.append(Task.due_date >= due_from)
+    due_to = _api_arg('due_to', _api_date)
+    if due_to:
+        filters.append(Task.due_date <= due_to)
+    return _api_list(Task, TASK_API_FIELDS, TASK_API_DEFAULT, filters)
+
+
+@app.route('/api/changes', methods=['GET'])
+@api_auth.api_auth_required
+def api_changes():
+    """Changes to tasks, incomes and purchases after ``since`` (a seq from a previous call).
+
+    ``tables`` limits the feed (comma-separated); ``since=0`` returns every
+    live row. 410 means deletes after ``since`` were pruned: sync from 0.
+    """
+    since = _api_arg('since', int) or 0
+    if since < 0:
+        raise APIError(f'invalid since: {since}')
+    tables = [t.strip() for t in request.args.get('tables', '').split(',') if t.strip()]
+    unknown = [t for t in tables if t not in changes.TABLES]
+    if unknown:
+        raise APIError(f"unknown tables: {', '.join(unknown)}")
+    limit = _api_arg('limit', int) or app.config.get('API_PAGE_SIZE', 100)
+    limit = min(max(limit, 1), app.config.get('API_MAX_PAGE_SIZE', 1000))
+    if since:
+        horizon = changes.pruned_through()
+        if since < horizon:
+            return jsonify({'error': 'change history pruned, sync again from since=0', 'pruned_through': horizon}), 410
+    return jsonify(changes.read(since, limit, tables))
 
 if __name__ == '__main__':
     # Production: Set debug=False
     # Development: Set debug=True
     debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    # Local runs bring the schema up to date; deployments use `flask db-upgrade`
+    with app.app_context():
+        migrations.upgrade(db.engine)
     app.run(debug=debug_mode, port=5001)
@@ -0,0 +1,120 @@
+"""Audit log writer.
+
+``record()`` queues a Log row in memory; a background thread writes the
+queue in batches every AUDIT_FLUSH_SECONDS, one transaction per batch, so
+a request no longer pays a second commit (an fsync on SQLite) for its
+audit entry. The queue holds at most AUDIT_QUEUE_SIZE rows; when it is
+full the row is written inline instead of being dropped. Pending rows are
+flushed when the process exits.
+
+Security-relevant events use ``record(..., sync=True)``: the row is added
+to the caller's session and commits atomically with the change it
+describes. Every other entry is recorded after the request's commit.
+"""
+import atexit
+import os
+import queue
+import threading
+from datetime import datetime
+
+from models import db, Log
+
+
+BATCH_SIZE = 500
+
+_app = None
+_queue = None
+_thread = None
+_pid = None
+_stop = threading.Event()
+_start_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def init_app(app):
+    global _app
+    _app = app
+    atexit.register(close)
+
+
+def _async_enabled():
+    return _app is not None and _app.config.get('AUDIT_ASYNC', True)
+
+
+def _ensure_started():
+    """Start the writer thread in this process (again after a fork)"""
+    global _queue, _thread, _pid
+    if _pid == os.getpid():
+        return
+    with _start_lock:
+        if _pid == os.getpid():
+            return
+        _queue = queue.Queue(maxsize=_app.config.get('AUDIT_QUEUE_SIZE', 10000))
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name='audit-writer', daemon=True)
+        _thread.start()
+        _pid = os.getpid()
+
+
+def record(action, detail=None, created_by=None, sync=False):
+    """Record an audit entry; with ``sync`` it joins the caller's transaction.
+
+    Without ``sync``, call it after the caller's commit (or before it has
+    written anything): when the queue is off or full the row is written on a
+    separate connection, which would wait for the caller's own write lock.
+    """
+    if sync:
+        db.session.add(Log(action=action, detail=detail, created_by=created_by))
+        return
+    row = {'action': action, 'detail': detail, 'created_by': created_by, 'created_at': datetime.utcnow()}
+    if not _async_enabled():
+        _write([row])
+        return
+    _ensure_started()
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        _write([row])
+
+
+def _write(rows):
+    with _app.app_context():
+        with db.engine.begin() as conn:
+            conn.execute(Log.__table__.insert(), rows)
+
+
+def flush():
+    """Write every queued entry now"""
+    if _queue is None or _pid != os.getpid():
+        return
+    with _write_lock:
+        while True:
+            rows = []
+            try:
+                while len(rows) < BATCH_SIZE:
+                    rows.append(_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not rows:
+                return
+            try:
+                _write(rows)
+            except Exception as e:
+                print(f"Audit log write failed, {len(rows)} entries lost: {e}")
+
+
+def _run():
+    while True:
+        stopping = _stop.wait(_app.config.get('AUDIT_FLUSH_SECONDS', 1.0))
+        flush()
+        if stopping:
+            return
+
+
+def close():
+    """Stop the writer thread and flush what is left"""
+    if _thread is None or _pid != os.getpid():
+        return
+    _stop.set()
+    _thread.join(timeout=5)
+    flush()
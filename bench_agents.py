@@ -0,0 +1,71 @@
+"""Benchmark bulk agent import: agents imported per second by HASH_WORKERS.
+
+Imports an agents CSV through the spreadsheet importer into a temporary
+database, once per worker count, and prints the rate of each run:
+
+    python bench_agents.py --agents 200 --workers 1 4
+"""
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+import time
+
+TMP = tempfile.mkdtemp(prefix='bench-agents-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TMP, 'bench.db')}"
+os.environ['AUDIT_ASYNC'] = '0'
+for name in ('USER_CACHE_STAMP', 'API_TOKEN_CACHE_STAMP', 'CATALOG_CACHE_STAMP'):
+    os.environ[name] = os.path.join(TMP, name.lower())
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+import importer  # noqa: E402
+import migrations  # noqa: E402
+import passwords  # noqa: E402
+
+
+def write_sheet(path, run, count):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'phone', 'email'])
+        for i in range(count):
+            writer.writerow([f'Bench {run}-{i}', f'0500{i:06d}', f'bench{run}.{i}@example.com'])
+
+
+def run(count, workers, index):
+    app.config['HASH_WORKERS'] = workers
+    passwords.shutdown()
+    path = os.path.join(TMP, f'agents-{index}.csv')
+    write_sheet(path, index, count)
+    with app.app_context():
+        # start the pool outside the timed section, as a long-running worker would have
+        passwords.hash_many(['warm-up'] * workers)
+        start = time.perf_counter()
+        reports = importer.import_file(path, name='agents.csv')
+        elapsed = time.perf_counter() - start
+    imported = sum(r['agents'] for r in reports)
+    assert imported == count, importer.summarize(reports)
+    return imported / elapsed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=200, help='agents per run (default: 200)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help='HASH_WORKERS values to compare (default: 1 and the CPU count)')
+    args = parser.parse_args()
+    try:
+        with app.app_context():
+            migrations.upgrade(db.engine)
+        print(f'{args.agents} agents per run, {os.cpu_count()} CPU(s)')
+        for index, workers in enumerate(dict.fromkeys(args.workers)):
+            rate, elapsed = run(args.agents, workers, index)
+            print(f'HASH_WORKERS={workers:<3} {elapsed:7.2f}s  {rate:8.1f} agents/s')
+    finally:
+        passwords.shutdown()
+        shutil.rmtree(TMP, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
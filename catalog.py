@@ -0,0 +1,65 @@
+"""Per-worker cache of the service-type and car-type name lists.
+
+The income form offers both lists and the income POST adds names it has
+not seen. Both are served from memory: the lists are loaded once per
+worker, and a name already in the cache costs no query. An unknown name is
+inserted with INSERT ... ON CONFLICT DO NOTHING on the caller's
+transaction, so two workers adding the same name at once cannot fail.
+After the commit the caller calls ``invalidate()``, which bumps the
+CATALOG_CACHE_STAMP file so every worker reloads (see stamps.py).
+"""
+import threading
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, ServiceType, CarType
+import stamps
+
+
+_app = None
+_cache = {}
+_lock = threading.Lock()
+_stamp = None
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def names(model):
+    """Sorted names of a catalog model (ServiceType or CarType)"""
+    global _stamp
+    stamp = stamps.read(_app.config['CATALOG_CACHE_STAMP'])
+    with _lock:
+        if stamp != _stamp:
+            _cache.clear()
+            _stamp = stamp
+        cached = _cache.get(model)
+    if cached is not None:
+        return cached
+    loaded = [name for (name,) in db.session.query(model.name).order_by(model.name)]
+    with _lock:
+        if _stamp == stamp:
+            _cache[model] = loaded
+    return loaded
+
+
+def add(model, name):
+    """Insert ``name`` unless it is already known; returns True if it was new.
+
+    The insert joins the caller's transaction; call invalidate() after the
+    commit when this returned True.
+    """
+    name = (name or '').strip()
+    if not name or name in names(model):
+        return False
+    db.session.execute(sqlite_insert(model.__table__).values(name=name).on_conflict_do_nothing(index_elements=['name']))
+    return True
+
+
+def invalidate():
+    """Make every worker reload the lists"""
+    with _lock:
+        _cache.clear()
+    stamps.bump(_app.config['CATALOG_CACHE_STAMP'])
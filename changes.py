@@ -0,0 +1,93 @@
+"""Change feed for Task, Income and Purchase (``/api/changes``).
+
+SQLite triggers on the three tables (created by migration 0008) keep one
+change_log entry per row: every insert, update or delete replaces the row's
+previous entry with a new one carrying the next ``seq``. A client syncs by asking for everything after the
+last seq it saw; since the log holds only each row's latest change, it never
+replays intermediate versions, and ``since=0`` is a full snapshot of the
+live rows.
+
+Delete entries (tombstones) are the only history that has to be kept for
+the clients' sake; ``prune()`` drops the ones older than
+CHANGE_RETENTION_DAYS and records the highest pruned seq. A client whose
+cursor is older than that has to start again from 0.
+"""
+from datetime import datetime, timedelta
+
+from models import db, Task, Income, Purchase, ChangeLog, ChangeFeed
+
+
+# table name -> (model, columns sent with each upsert)
+TABLES = {
+    'task': (Task, ('id', 'title', 'description', 'agent_id', 'due_date', 'completed', 'completed_at',
+                    'car_count', 'income_id', 'assigned_at', 'updated_at')),
+    'income': (Income, ('id', 'agent_id', 'amount', 'source', 'customer_name', 'service_type', 'car_type',
+                        'note', 'date', 'invoice_number')),
+    'purchase': (Purchase, ('id', 'agent_id', 'amount', 'note', 'date')),
+}
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def pruned_through():
+    feed = db.session.get(ChangeFeed, 1)
+    return feed.pruned_through if feed else 0
+
+
+def read(since=0, limit=100, tables=None):
+    """Changes after ``since``, oldest first.
+
+    Returns ``{'changes', 'next', 'more'}``; ``next`` is the cursor for the
+    following call. Upserts carry the row's current columns, deletes only
+    the id. Rows are fetched with one query per table.
+    """
+    query = db.session.query(ChangeLog.seq, ChangeLog.table_name, ChangeLog.row_id, ChangeLog.op).filter(ChangeLog.seq > since)
+    if tables:
+        query = query.filter(ChangeLog.table_name.in_(tables))
+    entries = query.order_by(ChangeLog.seq).limit(limit + 1).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    wanted = {}
+    for entry in entries:
+        if entry.op != 'D':
+            wanted.setdefault(entry.table_name, []).append(entry.row_id)
+    current = {}
+    for table, ids in wanted.items():
+        model, fields = TABLES[table]
+        rows = db.session.query(*(getattr(model, f) for f in fields)).filter(model.id.in_(ids)).all()
+        current[table] = {row.id: {f: _json_value(v) for f, v in zip(fields, row)} for row in rows}
+
+    changes = []
+    for entry in entries:
+        data = current.get(entry.table_name, {}).get(entry.row_id)
+        change = {'seq': entry.seq, 'table': entry.table_name, 'id': entry.row_id}
+        if data is None:
+            # deleted (or a delete is about to be logged) since the entry was written
+            change['op'] = 'delete'
+        else:
+            change['op'] = 'upsert'
+            change['data'] = data
+        changes.append(change)
+    return {'changes': changes, 'next': entries[-1].seq if entries else since, 'more': more}
+
+
+def prune(app, days=None):
+    """Delete tombstones older than ``days``; returns the number removed"""
+    days = app.config.get('CHANGE_RETENTION_DAYS', 30) if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    old = ChangeLog.query.filter(ChangeLog.op == 'D', ChangeLog.changed_at < cutoff)
+    highest = old.with_entities(db.func.max(ChangeLog.seq)).scalar()
+    if highest is None:
+        return 0
+    removed = old.delete(synchronize_session=False)
+    feed = db.session.get(ChangeFeed, 1)
+    if feed is None:
+        feed = ChangeFeed(id=1, pruned_through=0)
+        db.session.add(feed)
+    feed.pruned_through = max(feed.pruned_through or 0, highest)
+    feed.pruned_at = datetime.utcnow()
+    db.session.commit()
+    return removed
@@ -10,4 +10,63 @@ default_secret = secrets.token_urlsafe(32)
 SECRET_KEY = os.getenv('SECRET_KEY', default_secret)
 
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
+ALLOWED_EXTENSIONS = {'xls', 'xlsx', 'csv'}
+
+# Months expanded per page on the expenses (leader) page
+LEADER_MONTHS_PER_PAGE = int(os.getenv('LEADER_MONTHS_PER_PAGE', 3))
+
+# Background spreadsheet imports run concurrently on this many threads
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', 2))
+
+# A running import whose heartbeat is older than this is treated as interrupted
+IMPORT_STALE_SECONDS = int(os.getenv('IMPORT_STALE_SECONDS', 300))
+
+# Processes used to hash passwords when agents are created in bulk
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+
+# Rows per page on the /logs viewer
+LOGS_PER_PAGE = int(os.getenv('LOGS_PER_PAGE', 50))
+
+# Tasks per page on /tasks
+TASKS_PER_PAGE = int(os.getenv('TASKS_PER_PAGE', 50))
+
+# Audit log entries are queued and written in batches by a background thread
+AUDIT_ASYNC = os.getenv('AUDIT_ASYNC', '1') not in ('0', 'false', 'False')
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_FLUSH_SECONDS = float(os.getenv('AUDIT_FLUSH_SECONDS', 1.0))
+
+# Audit logs older than this are moved to gzip JSONL archives by `flask archive-logs`
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 180))
+LOG_ARCHIVE_FOLDER = os.getenv('LOG_ARCHIVE_FOLDER', os.path.join(BASE_DIR, 'archive', 'logs'))
+
+# Rendered invoice pages are cached here, one file per invoice version
+INVOICE_CACHE_FOLDER = os.getenv('INVOICE_CACHE_FOLDER', os.path.join(BASE_DIR, 'cache', 'invoices'))
+
+# Invoice numbers each worker reserves from the counter at a time
+INVOICE_BLOCK_SIZE = int(os.getenv('INVOICE_BLOCK_SIZE', 20))
+
+# Delete entries of the /api/changes feed are kept this long; a client that has
+# not synced for longer must start again from since=0
+CHANGE_RETENTION_DAYS = int(os.getenv('CHANGE_RETENTION_DAYS', 30))
+
+# Logged-in users are cached per worker for this many seconds; edits to an
+# account touch the stamp file so every worker drops its cache at once
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+USER_CACHE_STAMP = os.getenv('USER_CACHE_STAMP', os.path.join(BASE_DIR, '.user-cache-stamp'))
+
+# Touched when a service or car type is added; workers reload their cached lists
+CATALOG_CACHE_STAMP = os.getenv('CATALOG_CACHE_STAMP', os.path.join(BASE_DIR, '.catalog-cache-stamp'))
+
+# API bearer tokens: verification cache lifetime, its cross-worker stamp file,
+# and how often per-token usage counters are written
+API_TOKEN_CACHE_TTL = int(os.getenv('API_TOKEN_CACHE_TTL', 300))
+API_TOKEN_CACHE_STAMP = os.getenv('API_TOKEN_CACHE_STAMP', os.path.join(BASE_DIR, '.api-token-cache-stamp'))
+API_USAGE_FLUSH_SECONDS = int(os.getenv('API_USAGE_FLUSH_SECONDS', 30))
+
+# How list views load each row's agent: 'joined' (same query) or 'selectin'
+# (one extra IN query per page)
+AGENT_EAGER_LOADING = os.getenv('AGENT_EAGER_LOADING', 'joined')
+
+# Default and maximum page size of the JSON API
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 1000))
@@ -0,0 +1,92 @@
+"""Process-local cache for the Flask-Login user loader.
+
+Every authenticated request used to load its Admin/Agent row. The loader
+now keeps the row's columns (without the password hash) per session id,
+e.g. "agent:7", for USER_CACHE_TTL seconds and returns a fresh transient
+instance built from them, so a request never holds a session-bound user.
+Code that needs to write to the user must load the row itself.
+
+Invalidation bumps the USER_CACHE_STAMP file (see stamps.py), which every
+worker checks on each lookup, so edits and deactivations apply in all
+workers at once.
+"""
+import threading
+import time
+
+from models import db, Admin, Agent
+import stamps
+
+
+MODELS = {'admin': Admin, 'agent': Agent}
+EXCLUDED = {'password_hash'}
+
+_app = None
+_cache = {}
+_lock = threading.Lock()
+_stamp = None
+stats = {'hits': 0, 'misses': 0}
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def _columns(obj):
+    return {attr.key: getattr(obj, attr.key) for attr in db.inspect(type(obj)).column_attrs if attr.key not in EXCLUDED}
+
+
+def load(user_id):
+    """Return a detached Admin/Agent for a session id, or None"""
+    global _stamp
+    try:
+        kind, raw_id = str(user_id).split(':', 1)
+        model, _id = MODELS[kind], int(raw_id)
+    except (KeyError, ValueError):
+        return None
+
+    ttl = _app.config.get('USER_CACHE_TTL', 60)
+    stamp = stamps.read(_app.config['USER_CACHE_STAMP'])
+    now = time.monotonic()
+    with _lock:
+        if stamp != _stamp:
+            _cache.clear()
+            _stamp = stamp
+        entry = _cache.get(user_id)
+        if entry is not None and entry[0] > now:
+            stats['hits'] += 1
+            values = entry[1]
+        else:
+            stats['misses'] += 1
+            values = None
+    if values is None:
+        obj = db.session.get(model, _id)
+        if obj is None or (model is Agent and obj.is_active is False):
+            values = False
+        else:
+            values = _columns(obj)
+        with _lock:
+            if _stamp == stamp:  # not invalidated while we were loading
+                _cache[user_id] = (now + ttl, values)
+    return model(**values) if values else None
+
+
+def invalidate(user_id=None):
+    """Forget a cached identity ("agent:<id>"), or all of them, in every worker"""
+    with _lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
+    stamps.bump(_app.config['USER_CACHE_STAMP'])
+
+
+def hit_rate():
+    """Cache statistics for the settings page"""
+    total = stats['hits'] + stats['misses']
+    return {
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'size': len(_cache),
+        'hit_rate': round(100 * stats['hits'] / total, 1) if total else 0,
+    }
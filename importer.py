@@ -0,0 +1,408 @@
+"""Bulk spreadsheet and CSV import for agents, purchases and income.
+
+Sheets are classified by their column headers (see README, "Excel Import").
+Columns are validated and normalized with vectorized pandas operations,
+usernames are allocated in memory against one prefetched set, and rows are
+written with executemany INSERTs committed in chunks of CHUNK_SIZE. The
+monthly rollups are updated, and the chunk's invoice numbers reserved, in
+the same transaction as each chunk.
+
+Every imported row carries an import key derived from its values (and how
+many identical rows came before it in the file), so importing the same
+rows again, e.g. after a failed job or an overlapping sheet, skips them.
+Rows are inserted with ON CONFLICT (import_key) DO NOTHING, so two
+overlapping files imported at the same time cannot both insert a row.
+
+Memory stays bounded however long the file is: occurrences are counted in
+a fixed table of OCCURRENCE_SLOTS counters indexed by a hash of the row
+(see ``_key``), and a sheet report keeps the rejected count plus the first
+REJECTED_SAMPLE rejected rows.
+Undated rows are keyed with the date they are stored under (the import
+day), so the same undated row in a later upload is not mistaken for it.
+"""
+import hashlib
+import os
+from array import array
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Agent, Purchase, Income
+import invoices
+import passwords
+import rollups
+
+
+CHUNK_SIZE = 500
+
+# 4-byte occurrence counters (4 MB), see SpreadsheetImporter._key
+OCCURRENCE_SLOTS = 1 << 20
+
+# rejected rows listed in a sheet report; the rest are only counted
+REJECTED_SAMPLE = 20
+
+# attempts at a chunk of agents whose usernames were taken concurrently
+USERNAME_RETRIES = 3
+
+NAME_KEYS = ('name', 'nome', 'agent', 'agent_name')
+
+
+def _text(df, col):
+    """Stripped string column with blanks as <NA>, or an all-<NA> column"""
+    if col is None:
+        return pd.Series(pd.NA, index=df.index, dtype='string')
+    values = df[col].astype('string').str.strip()
+    return values.mask(values == '')
+
+
+def _dates(df, col, default):
+    if col is None:
+        # a list, not a scalar: pd.Series(None, dtype=object) would hold NaN
+        return pd.Series([default] * len(df), index=df.index, dtype=object)
+    parsed = pd.to_datetime(df[col], errors='coerce', format='mixed')
+    return pd.Series([d.date() if not pd.isna(d) else default for d in parsed], index=df.index, dtype=object)
+
+
+def _none(value):
+    return None if pd.isna(value) else value
+
+
+class SpreadsheetImporter:
+    """Import DataFrames sheet by sheet, accumulating a report per sheet.
+
+    The same instance can be fed several frames of one sheet (e.g. chunks of
+    a large file); username and agent-id lookups are prefetched once.
+    ``progress(processed_rows)`` is called inside each chunk's transaction.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, progress=None):
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.processed = 0
+        self.reports = {}
+        self.seen = array('I', bytes(4 * OCCURRENCE_SLOTS))
+        self.usernames = self._stored_usernames()
+        self.agent_ids = {i for (i,) in db.session.query(Agent.id)}
+
+    def report(self, sheet):
+        return self.reports.setdefault(sheet, {'sheet': sheet, 'agents': 0, 'purchases': 0, 'income': 0, 'skipped': 0,
+                                                'rejected': 0, 'rejected_rows': []})
+
+    def import_frame(self, sheet, df):
+        """Import one frame whose index holds the spreadsheet row numbers"""
+        report = self.report(sheet)
+        cols = {str(c).strip().lower(): c for c in df.columns}
+        amount_col = cols.get('amount') or cols.get('valor')
+        name_col = next((cols[k] for k in NAME_KEYS if k in cols), None)
+
+        if amount_col is not None and 'source' in cols:
+            self._import_income(df, cols, report)
+        elif amount_col is not None:
+            self._import_purchases(df, cols, amount_col, report)
+        elif name_col is not None:
+            self._import_agents(df, cols, name_col, report)
+        self.processed += len(df)
+        if self.progress:
+            self.progress(self.processed)
+            db.session.commit()
+        return report
+
+    def _reject(self, report, mask, reason):
+        rows = mask[mask].index
+        report['rejected'] += len(rows)
+        room = REJECTED_SAMPLE - len(report['rejected_rows'])
+        report['rejected_rows'].extend((row, reason) for row in rows[:max(room, 0)])
+
+    def _key(self, *values):
+        """Import key for a row: its values plus the occurrence number of identical rows.
+
+        Occurrences are counted per hash slot rather than per distinct row,
+        so memory does not grow with the file. A row alone in its slot gets
+        the exact count of its identical copies, as before. Different rows
+        sharing a slot get higher, still distinct numbers; the same file
+        always yields the same keys, but in a different file such a row may
+        not be recognized as already imported.
+        """
+        base = '\x1f'.join('' if v is None else str(v) for v in values)
+        slot = int.from_bytes(hashlib.sha1(base.encode()).digest()[:8], 'big') % OCCURRENCE_SLOTS
+        self.seen[slot] += 1
+        return hashlib.sha1(f'{base}\x1f{self.seen[slot]}'.encode()).hexdigest()
+
+    def _known_keys(self, model, keys):
+        """The subset of ``keys`` already stored in the model's table.
+
+        Only used to avoid hashing passwords for agents that are already
+        imported; whether a row is new is decided by the INSERT.
+        """
+        table = model.__table__
+        keys = list(keys)
+        known = set()
+        for start in range(0, len(keys), self.chunk_size):
+            known.update(k for (k,) in db.session.execute(
+                db.select(table.c.import_key).where(table.c.import_key.in_(keys[start:start + self.chunk_size]))))
+        return known
+
+    def _insert(self, model, chunk, bases=None):
+        """Insert a chunk, skipping rows whose import key is stored; returns the keys inserted.
+
+        Another import of an overlapping file may store the same keys at any
+        moment, so the conflict is resolved by the INSERT itself. A username
+        taken in the meantime (by agent_new or another import) rolls the
+        chunk back; its usernames are allocated again from ``bases``.
+        """
+        table = model.__table__
+        stmt = sqlite_insert(table).on_conflict_do_nothing(index_elements=['import_key']).returning(table.c.import_key)
+        for attempt in range(USERNAME_RETRIES):
+            try:
+                return {k for (k,) in db.session.execute(stmt, chunk)}
+            except IntegrityError:
+                if model is not Agent or attempt == USERNAME_RETRIES - 1:
+                    raise
+                # the chunk is the transaction's only write, so nothing else is lost
+                db.session.rollback()
+                self.usernames = self._stored_usernames()
+                for row in chunk:
+                    row['username'] = self._allocate_username(bases[row['import_key']])
+
+    def _write(self, model, rows, report, bases=None):
+        """Insert rows whose import key is new; returns the number inserted"""
+        inserted = 0
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            if chunk:
+                if model is Income:
+                    numbers = invoices.allocate(db.session.connection(), len(chunk))
+                    chunk = [dict(r, invoice_number=n) for r, n in zip(chunk, numbers)]
+                keys = self._insert(model, chunk, bases)
+                new_rows = [r for r in chunk if r['import_key'] in keys]
+                report['skipped'] += len(chunk) - len(new_rows)
+                if model is not Agent:
+                    rollups.apply_rows(db.session.connection(), model, new_rows)
+                inserted += len(new_rows)
+            if self.progress:
+                self.progress(self.processed + start + len(chunk))
+            db.session.commit()
+        return inserted
+
+    @staticmethod
+    def _stored_usernames():
+        return {u for (u,) in db.session.query(Agent.username).filter(Agent.username.isnot(None))}
+
+    def _allocate_username(self, base):
+        base = base or f"agent{int(datetime.utcnow().timestamp())}"
+        username, idx = base, 1
+        while username in self.usernames:
+            idx += 1
+            username = f"{base}.{idx}"
+        self.usernames.add(username)
+        return username
+
+    def _import_agents(self, df, cols, name_col, report):
+        names = _text(df, name_col)
+        phones = _text(df, cols.get('phone') or cols.get('telefone'))
+        emails = _text(df, cols.get('email') or cols.get('e-mail'))
+        missing = names.isna()
+        self._reject(report, missing, 'missing name')
+
+        bases = emails.fillna(names).str.lower().str.replace(r'[\W_]', '.', regex=True)
+        index = names[~missing].index
+        keys = {idx: self._key('agent', names[idx], _none(phones[idx]), _none(emails[idx])) for idx in index}
+        known = self._known_keys(Agent, keys.values())
+        index = [idx for idx in index if keys[idx] not in known]
+        report['skipped'] += len(known)
+        credentials = passwords.new_credentials(len(index))
+        rows = []
+        for idx, (_, password_hash) in zip(index, credentials):
+            rows.append({
+                'name': names[idx],
+                'phone': _none(phones[idx]),
+                'email': _none(emails[idx]),
+                'username': self._allocate_username(bases[idx]),
+                'password_hash': password_hash,
+                'is_active': True,
+                'import_key': keys[idx],
+            })
+        inserted = self._write(Agent, rows, report, bases={keys[idx]: bases[idx] for idx in index})
+        if inserted:
+            self.agent_ids = {i for (i,) in db.session.query(Agent.id)}
+        report['agents'] += inserted
+
+    def _amounts(self, df, col, report):
+        raw = df[col]
+        amounts = pd.to_numeric(raw, errors='coerce')
+        self._reject(report, raw.isna(), 'missing amount')
+        self._reject(report, raw.notna() & amounts.isna(), 'invalid amount')
+        return amounts
+
+    def _import_purchases(self, df, cols, amount_col, report):
+        amounts = self._amounts(df, amount_col, report)
+        valid = amounts.notna()
+
+        agent_col = cols.get('agent_id') or cols.get('agent')
+        agent_ids = pd.Series(float('nan'), index=df.index)
+        if agent_col is not None:
+            agent_ids = pd.to_numeric(df[agent_col], errors='coerce')
+            bad = valid & df[agent_col].notna() & (agent_ids.isna() | ~agent_ids.isin(self.agent_ids))
+            self._reject(report, bad, 'unknown agent')
+            valid &= ~bad
+
+        dates = _dates(df, cols.get('date'), None)
+        today = datetime.utcnow().date()
+        notes = _text(df, cols.get('note')).fillna('')
+        rows = []
+        for idx in df.index[valid]:
+            agent_id = None if pd.isna(agent_ids[idx]) else int(agent_ids[idx])
+            amount = float(amounts[idx])
+            date = dates[idx] or today
+            rows.append({
+                'agent_id': agent_id,
+                'amount': amount,
+                'note': notes[idx],
+                'date': date,
+                'import_key': self._key('purchase', agent_id, amount, date, notes[idx]),
+            })
+        report['purchases'] += self._write(Purchase, rows, report)
+
+    def _import_income(self, df, cols, report):
+        amounts = self._amounts(df, cols['amount'], report)
+        valid = amounts.notna()
+        dates = _dates(df, cols.get('date'), None)
+        today = datetime.utcnow().date()
+        sources = _text(df, cols['source']).fillna('')
+        notes = _text(df, cols.get('note')).fillna('')
+        rows = []
+        for idx in df.index[valid]:
+            amount = float(amounts[idx])
+            date = dates[idx] or today
+            rows.append({
+                'amount': amount,
+                'source': sources[idx],
+                'note': notes[idx],
+                'date': date,
+                'import_key': self._key('income', amount, sources[idx], date, notes[idx]),
+            })
+        report['income'] += self._write(Income, rows, report)
+
+
+def _frames_from_rows(rows, header, chunk_rows):
+    """Group (row_number, values) pairs into DataFrames of chunk_rows rows"""
+    numbers, chunk = [], []
+    for number, values in rows:
+        numbers.append(number)
+        chunk.append(values)
+        if len(chunk) >= chunk_rows:
+            yield pd.DataFrame(chunk, columns=header, index=numbers)
+            numbers, chunk = [], []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=header, index=numbers)
+
+
+def _xlsx_frames(path, chunk_rows):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            width = len(header)
+            numbered = (
+                (number, (values + (None,) * width)[:width])
+                for number, values in enumerate(rows, start=2)
+                if any(v is not None and v != '' for v in values)
+            )
+            for df in _frames_from_rows(numbered, list(header), chunk_rows):
+                yield ws.title, df
+    finally:
+        wb.close()
+
+
+def _csv_frames(path, chunk_rows, name):
+    sheet = os.path.splitext(os.path.basename(name or path))[0]
+    reader = pd.read_csv(path, chunksize=chunk_rows, dtype=str, skip_blank_lines=False, encoding='utf-8-sig')
+    first = 2
+    for df in reader:
+        df.index = range(first, first + len(df))
+        first += len(df)
+        yield sheet, df.dropna(how='all')
+
+
+def _xls_frames(path, chunk_rows):
+    for sheet, df in pd.read_excel(path, sheet_name=None).items():
+        df.index = range(2, len(df) + 2)
+        for start in range(0, len(df), chunk_rows):
+            yield sheet, df.iloc[start:start + chunk_rows]
+
+
+def count_rows(path):
+    """Cheap data-row estimate for progress reporting, without loading the file"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        with open(path, 'rb') as f:
+            return max(sum(1 for _ in f) - 1, 0)
+    if ext == '.xlsx':
+        from openpyxl import load_workbook
+
+        wb = load_workbook(path, read_only=True)
+        try:
+            return sum(max((ws.max_row or 1) - 1, 0) for ws in wb.worksheets)
+        finally:
+            wb.close()
+    return 0
+
+
+def iter_frames(path, chunk_rows=CHUNK_SIZE, name=None):
+    """Yield (sheet, DataFrame) chunks of at most chunk_rows rows from a file.
+
+    xlsx is streamed in openpyxl read-only mode and CSV with pandas'
+    chunked reader, so memory use does not grow with the file size. Legacy
+    .xls files can only be read whole. Each frame's index holds the
+    spreadsheet row numbers, used when reporting rejected rows. A CSV
+    file's single sheet is named after ``name`` (the uploaded filename).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return _csv_frames(path, chunk_rows, name)
+    if ext == '.xlsx':
+        return _xlsx_frames(path, chunk_rows)
+    return _xls_frames(path, chunk_rows)
+
+
+def import_file(path, progress=None, on_total=None, name=None):
+    """Import every sheet of a spreadsheet or CSV file; returns the per-sheet reports.
+
+    ``on_total(rows)`` is called with the estimated row count before importing.
+    """
+    if on_total:
+        on_total(count_rows(path))
+    importer = SpreadsheetImporter(progress=progress)
+    for sheet, df in iter_frames(path, importer.chunk_size, name):
+        importer.import_frame(sheet, df)
+    return list(importer.reports.values())
+
+
+def summarize(reports):
+    """One-line summary per sheet, e.g. 'Sheet1: Purchases:120, rejected:2'"""
+    parts = []
+    for r in reports:
+        counts = [f'{label}:{r[key]}' for key, label in (('agents', 'Agents'), ('purchases', 'Purchases'), ('income', 'Income')) if r[key]]
+        if r['skipped']:
+            counts.append(f"already imported:{r['skipped']}")
+        if r['rejected']:
+            counts.append(f"rejected:{r['rejected']}")
+        if counts:
+            parts.append(f"{r['sheet']}: {', '.join(counts)}")
+    return '; '.join(parts)
+
+
+def describe_rejected(report, limit=10):
+    """List the first rejected rows of a sheet report, e.g. '4 (missing amount), 9 (unknown agent)'"""
+    rejected = report['rejected_rows'][:limit]
+    text = ', '.join(f'{row} ({reason})' for row, reason in rejected)
+    if report['rejected'] > len(rejected):
+        text += f" … +{report['rejected'] - len(rejected)}"
+    return text
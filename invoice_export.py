@@ -0,0 +1,125 @@
+"""Rendered-invoice cache and batch invoice export.
+
+An invoice page depends only on its income row, the agent's name and phone
+and the template. Rendered pages are kept on disk under INVOICE_CACHE_FOLDER
+with a version built from the income's change-log seq (every write gives
+the row a new one, see changes.py), the agent's updated_at and the
+template's digest, so an unchanged invoice is rendered once, by whichever
+worker needs it first. The stale version is deleted when a new one is
+written.
+
+Misses are rendered with a plain Jinja environment, since the template needs
+no request context, so batch exports can render while their response is
+streamed. Pages are rendered and written in chunks of RENDER_CHUNK.
+"""
+import hashlib
+import os
+import re
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import escape
+
+from models import db, Income, Agent, ChangeLog
+
+
+TEMPLATE = 'invoice.html'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+RENDER_CHUNK = 200
+
+INCOME_COLUMNS = ('id', 'agent_id', 'invoice_number', 'date', 'amount', 'source', 'customer_name',
+                  'service_type', 'car_type', 'note')
+
+_app = None
+_env = None
+_template_digest = None
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def _render(contexts):
+    global _env
+    if _env is None:
+        _env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+    template = _env.get_template(TEMPLATE)
+    return [template.render(**context) for context in contexts]
+
+
+def rows(filters):
+    """Invoice data for the incomes matching ``filters``, ordered by date"""
+    query = db.session.query(
+        *(getattr(Income, c) for c in INCOME_COLUMNS),
+        Agent.name.label('agent_name'), Agent.phone.label('agent_phone'),
+        Agent.updated_at.label('agent_updated_at'), ChangeLog.seq.label('seq'),
+    ).outerjoin(Agent, Agent.id == Income.agent_id).outerjoin(
+        ChangeLog, (ChangeLog.table_name == 'income') & (ChangeLog.row_id == Income.id)
+    )
+    return [row._asdict() for row in query.filter(*filters).order_by(Income.date, Income.id)]
+
+
+def _context(row):
+    agent = {'name': row['agent_name'], 'phone': row['agent_phone']} if row['agent_name'] is not None else None
+    return {'income': {c: row[c] for c in INCOME_COLUMNS}, 'agent': agent}
+
+
+def _version(row):
+    global _template_digest
+    if _template_digest is None:
+        with open(os.path.join(TEMPLATE_DIR, TEMPLATE), 'rb') as f:
+            _template_digest = hashlib.sha1(f.read()).hexdigest()
+    # rows written before the change log existed have no seq; use their values instead
+    row_version = row['seq'] if row['seq'] is not None else repr(_context(row))
+    key = f"{row_version}:{row['agent_updated_at']}:{_template_digest}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _path(row):
+    shard = os.path.join(_app.config['INVOICE_CACHE_FOLDER'], str(row['id'] // 1000))
+    return shard, f"{row['id']}-{_version(row)}.html"
+
+
+def _store(shard, name, html):
+    os.makedirs(shard, exist_ok=True)
+    tmp = os.path.join(shard, f'.{name}.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(html)
+    os.replace(tmp, os.path.join(shard, name))
+    prefix = name.split('-', 1)[0] + '-'
+    for old in os.listdir(shard):
+        if old.startswith(prefix) and old != name:
+            try:
+                os.remove(os.path.join(shard, old))
+            except OSError:
+                pass
+
+
+def rendered(invoice_rows):
+    """Yield (row, path of the rendered page) in order, rendering the misses in chunks"""
+    for start in range(0, len(invoice_rows), RENDER_CHUNK):
+        chunk = [(row,) + _path(row) for row in invoice_rows[start:start + RENDER_CHUNK]]
+        misses = [item for item in chunk if not os.path.exists(os.path.join(item[1], item[2]))]
+        if misses:
+            for (row, shard, name), html in zip(misses, _render([_context(row) for row, _, _ in misses])):
+                _store(shard, name, html)
+        for row, shard, name in chunk:
+            yield row, os.path.join(shard, name)
+
+
+_BODY = re.compile(r'<div class="invoice-container">.*(?=</body>)', re.S)
+
+
+def printable(invoice_rows, title):
+    """One HTML document with every invoice, each on its own printed page"""
+    head = None
+    for row, path in rendered(invoice_rows):
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        if head is None:
+            head = html[:html.index('<body>')]
+            head = re.sub(r'<title>.*?</title>', f'<title>{escape(title)}</title>', head, count=1)
+            yield head.replace('</style>', '  .invoice-container { margin-bottom: 20px; page-break-after: always; }\n  </style>', 1)
+            yield '<body>\n  <button class="print-button" onclick="window.print()">🖨️ طباعة الفواتير</button>\n'
+        yield _BODY.search(html).group(0)
+    yield '</body>\n</html>\n'
@@ -0,0 +1,76 @@
+"""Invoice number allocation.
+
+Numbers come from a counter row in invoice_counter. Allocating advances the
+counter by a whole range in one UPDATE, so a caller gets any number of
+consecutive values for a single round-trip.
+
+Web workers take INVOICE_BLOCK_SIZE numbers at a time and hand them out
+from memory, so concurrent workers touch the counter once per block rather
+than on every income. A block is reserved in its own short transaction
+rather than the request's: if the request rolls back, the numbers stay
+consumed instead of being handed out again by another worker. Numbers left
+in a block when a worker exits are never used, so the sequence has gaps
+and only guarantees uniqueness.
+"""
+import os
+import threading
+
+from sqlalchemy import text
+
+from models import db, InvoiceCounter
+
+
+COUNTER = 'invoice'
+
+_app = None
+_lock = threading.Lock()
+_block = iter(())
+_pid = None
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def format_number(value):
+    return f'INV-{value:06d}'
+
+
+def reserve(conn, count):
+    """Advance the counter by ``count`` on ``conn``; returns the range reserved.
+
+    The range belongs to the caller once ``conn``'s transaction commits.
+    """
+    table = InvoiceCounter.__table__
+    updated = conn.execute(
+        table.update().where(table.c.name == COUNTER).values(next_value=table.c.next_value + count)
+    ).rowcount
+    if not updated:
+        conn.execute(table.insert().values(name=COUNTER, next_value=1 + count))
+    end = conn.execute(text("SELECT next_value FROM invoice_counter WHERE name = :name"), {'name': COUNTER}).scalar()
+    return range(end - count, end)
+
+
+def next_number():
+    """One invoice number from this worker's block, e.g. 'INV-000042'.
+
+    Call it before the request writes anything: on SQLite a new block waits
+    for the write lock, which the request's own open transaction would hold.
+    """
+    global _block, _pid
+    with _lock:
+        if _pid != os.getpid():  # a forked worker must not share its parent's block
+            _block, _pid = iter(()), os.getpid()
+        value = next(_block, None)
+        if value is None:
+            with _app.app_context():
+                with db.engine.begin() as conn:
+                    _block = iter(reserve(conn, _app.config.get('INVOICE_BLOCK_SIZE', 20)))
+            value = next(_block)
+    return format_number(value)
+
+
+def allocate(conn, count):
+    """``count`` invoice numbers in one round-trip, on the caller's transaction (bulk imports)"""
+    return [format_number(v) for v in reserve(conn, count)]
@@ -0,0 +1,150 @@
+"""Background spreadsheet import jobs.
+
+An upload is recorded as an ImportJob row and handed to a bounded thread
+pool inside the app process (IMPORT_WORKERS threads, default 2), so several
+queued imports run concurrently without holding the upload request open.
+Status and progress are kept in the table, so any worker can answer a poll.
+
+The pool lives only in the worker that queued the job, so a job can outlive
+it. A running job refreshes ``heartbeat_at`` with every chunk; one whose
+heartbeat is older than IMPORT_STALE_SECONDS was interrupted and is marked
+failed. Queued jobs are re-enqueued by ``flask recover-imports`` and by each
+worker the first time it serves the upload page, not on every worker's
+first request; a job is claimed with a conditional update, so it runs once
+even when several workers enqueue it.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, ImportJob, FileUpload
+import audit
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_recovered_pid = None
+
+
+def _get_executor(app):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('IMPORT_WORKERS', 2),
+                thread_name_prefix='import-job',
+            )
+    return _executor
+
+
+def enqueue(app, job_id, path):
+    """Schedule an already committed ImportJob for execution"""
+    return _get_executor(app).submit(run_job, app, job_id, path)
+
+
+def shutdown():
+    """Wait for the enqueued jobs to finish"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _stale_before(app):
+    return datetime.utcnow() - timedelta(seconds=app.config.get('IMPORT_STALE_SECONDS', 300))
+
+
+def active(app):
+    """Filter for jobs that have imported, or will import, their file.
+
+    Queued jobs do not refresh their heartbeat while they wait, so only
+    running jobs are subject to the staleness cutoff.
+    """
+    return ImportJob.status.in_(('done', 'queued')) | (
+        (ImportJob.status == 'running') & (ImportJob.heartbeat_at >= _stale_before(app))
+    )
+
+
+def fail_stale(app):
+    """Mark running jobs whose heartbeat stopped as failed; returns how many"""
+    failed = db.session.query(ImportJob).filter(
+        ImportJob.status == 'running', ImportJob.heartbeat_at < _stale_before(app)
+    ).update({
+        'status': 'failed',
+        'error': 'Interrupted: the worker running this import stopped',
+        'finished_at': datetime.utcnow(),
+    }, synchronize_session=False)
+    db.session.commit()
+    return failed
+
+
+def recover(app):
+    """Enqueue the queued jobs in this worker; returns how many"""
+    queued = db.session.query(ImportJob.id, FileUpload.stored_name, FileUpload.filename).outerjoin(
+        FileUpload, FileUpload.id == ImportJob.file_id
+    ).filter(ImportJob.status == 'queued').all()
+    for job_id, stored_name, filename in queued:
+        stored = stored_name or filename
+        if stored is None:
+            _update(job_id, status='failed', error='Uploaded file not found', finished_at=datetime.utcnow())
+            continue
+        enqueue(app, job_id, os.path.join(app.config['UPLOAD_FOLDER'], stored))
+    db.session.commit()
+    return len(queued)
+
+
+def recover_once(app):
+    """``recover()`` the first time it is called in this process"""
+    global _recovered_pid
+    if _recovered_pid == os.getpid():
+        return
+    with _executor_lock:
+        if _recovered_pid == os.getpid():
+            return
+        _recovered_pid = os.getpid()
+    recover(app)
+
+
+def _update(job_id, **values):
+    db.session.query(ImportJob).filter(ImportJob.id == job_id).update(values)
+
+
+def run_job(app, job_id, path):
+    """Run one import job to completion inside its own app context"""
+    from importer import import_file, summarize, describe_rejected
+
+    with app.app_context():
+        now = datetime.utcnow()
+        claimed = db.session.query(ImportJob).filter(ImportJob.id == job_id, ImportJob.status == 'queued').update(
+            {'status': 'running', 'started_at': now, 'heartbeat_at': now}
+        )
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(ImportJob, job_id)
+        created_by, filename = job.created_by, job.filename
+
+        def on_total(rows):
+            _update(job_id, total_rows=rows, heartbeat_at=datetime.utcnow())
+            db.session.commit()
+
+        try:
+            reports = import_file(
+                path,
+                progress=lambda rows: _update(job_id, processed_rows=rows, heartbeat_at=datetime.utcnow()),
+                on_total=on_total,
+                name=filename,
+            )
+            summary = summarize(reports)
+            rejected = '\n'.join(f"{r['sheet']}: {describe_rejected(r)}" for r in reports if r['rejected'])
+            _update(job_id, status='done', processed_rows=ImportJob.total_rows, summary=summary, rejected=rejected or None, finished_at=datetime.utcnow())
+            if summary:
+                audit.record('import_excel', f'Imported: {summary} from {filename}', created_by, sync=True)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            _update(job_id, status='failed', error=str(e), finished_at=datetime.utcnow())
+            audit.record('import_error', f'Error importing {filename}: {e}', created_by, sync=True)
+            db.session.commit()
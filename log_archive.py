@@ -0,0 +1,111 @@
+"""Audit log retention.
+
+Log rows older than LOG_RETENTION_DAYS are appended to one gzip-compressed
+JSON-lines file per month (``logs-YYYY-MM.jsonl.gz`` in LOG_ARCHIVE_FOLDER)
+and deleted from the database in batches; the file is reclaimed with a
+VACUUM afterwards. Each run appends a new gzip member, so archive files are
+never rewritten. Archived months stay searchable from /logs.
+"""
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timedelta
+
+from models import db, Log
+
+
+_FILE = re.compile(r'^logs-(\d{4}-\d{2})\.jsonl\.gz$')
+
+
+def _folder(app):
+    folder = app.config['LOG_ARCHIVE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def archive_path(app, month):
+    return os.path.join(_folder(app), f'logs-{month}.jsonl.gz')
+
+
+def archived_months(app):
+    """Archived months ('YYYY-MM'), newest first"""
+    folder = app.config['LOG_ARCHIVE_FOLDER']
+    if not os.path.isdir(folder):
+        return []
+    months = [m.group(1) for m in map(_FILE.match, os.listdir(folder)) if m]
+    return sorted(months, reverse=True)
+
+
+def _append(app, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row.created_at.strftime('%Y-%m'), []).append(row)
+    for month, month_rows in by_month.items():
+        with open(archive_path(app, month), 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                for row in month_rows:
+                    gz.write(json.dumps({
+                        'id': row.id,
+                        'action': row.action,
+                        'detail': row.detail,
+                        'created_by': row.created_by,
+                        'created_at': row.created_at.isoformat(),
+                    }, ensure_ascii=False).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def archive_logs(app, days=None, batch_size=1000):
+    """Archive and delete logs older than ``days``; returns the number moved.
+
+    Each batch is written to the archive (and fsynced) before its rows are
+    deleted, so a crash can at worst archive a batch twice; readers skip
+    duplicate ids.
+    """
+    days = app.config.get('LOG_RETENTION_DAYS', 180) if days is None else days
+    cutoff = datetime.combine(datetime.utcnow().date() - timedelta(days=days), datetime.min.time())
+    table = Log.__table__
+    moved = 0
+    while True:
+        rows = db.session.execute(
+            db.select(table).where(table.c.created_at < cutoff)
+            .order_by(table.c.created_at, table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        _append(app, rows)
+        db.session.execute(table.delete().where(table.c.id.in_([r.id for r in rows])))
+        db.session.commit()
+        moved += len(rows)
+    if moved:
+        compact()
+    return moved
+
+
+def compact():
+    """Give the space freed by deleted rows back to the filesystem"""
+    # VACUUM cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            conn.exec_driver_sql('PRAGMA incremental_vacuum')
+        else:
+            conn.exec_driver_sql('VACUUM')
+
+
+def read_month(app, month):
+    """All archived entries of a month as dicts, oldest first, without duplicates"""
+    path = archive_path(app, month)
+    if not os.path.exists(path):
+        return []
+    seen, rows = set(), []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            if row['id'] in seen:
+                continue
+            seen.add(row['id'])
+            row['created_at'] = datetime.fromisoformat(row['created_at'])
+            rows.append(row)
+    rows.sort(key=lambda r: (r['created_at'], r['id']))
+    return rows
@@ -0,0 +1,163 @@
+"""Baseline schema, including the columns older databases were missing.
+
+Replaces the old first-request hook: creates any missing tables, adds the
+agent login, income and task columns added after the first release, and
+seeds the default admin account.
+
+The tables are created from the DDL below, frozen at the first release,
+not from the current models: every later change belongs to the migration
+that introduced it.
+"""
+from werkzeug.security import generate_password_hash
+
+from migrations import add_missing_columns
+
+
+BASELINE = (
+    """CREATE TABLE IF NOT EXISTS admin (
+        id INTEGER NOT NULL,
+        username VARCHAR(80) NOT NULL,
+        password_hash VARCHAR(200) NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (username)
+    )""",
+    """CREATE TABLE IF NOT EXISTS agent (
+        id INTEGER NOT NULL,
+        name VARCHAR(120) NOT NULL,
+        phone VARCHAR(50),
+        email VARCHAR(120),
+        params TEXT,
+        created_at DATETIME,
+        username VARCHAR(80),
+        password_hash VARCHAR(200),
+        is_active BOOLEAN,
+        PRIMARY KEY (id),
+        UNIQUE (username)
+    )""",
+    """CREATE TABLE IF NOT EXISTS car_type (
+        id INTEGER NOT NULL,
+        name VARCHAR(200) NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY (id),
+        UNIQUE (name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS service_type (
+        id INTEGER NOT NULL,
+        name VARCHAR(200) NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY (id),
+        UNIQUE (name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS api_token (
+        id INTEGER NOT NULL,
+        name VARCHAR(120) NOT NULL,
+        token VARCHAR(128) NOT NULL,
+        created_by INTEGER,
+        created_at DATETIME,
+        revoked BOOLEAN,
+        PRIMARY KEY (id),
+        UNIQUE (token),
+        FOREIGN KEY(created_by) REFERENCES admin (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS file_upload (
+        id INTEGER NOT NULL,
+        filename VARCHAR(300) NOT NULL,
+        uploaded_by INTEGER,
+        uploaded_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(uploaded_by) REFERENCES admin (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS income (
+        id INTEGER NOT NULL,
+        agent_id INTEGER,
+        amount FLOAT NOT NULL,
+        source VARCHAR(200),
+        customer_name VARCHAR(200),
+        service_type VARCHAR(200),
+        car_type VARCHAR(200),
+        note TEXT,
+        date DATE,
+        invoice_number VARCHAR(50),
+        PRIMARY KEY (id),
+        FOREIGN KEY(agent_id) REFERENCES agent (id),
+        UNIQUE (invoice_number)
+    )""",
+    """CREATE TABLE IF NOT EXISTS log (
+        id INTEGER NOT NULL,
+        action VARCHAR(200),
+        detail TEXT,
+        created_by INTEGER,
+        created_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(created_by) REFERENCES admin (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS monthly_target (
+        id INTEGER NOT NULL,
+        agent_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        target_cars INTEGER,
+        created_at DATETIME,
+        created_by INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(agent_id) REFERENCES agent (id),
+        FOREIGN KEY(created_by) REFERENCES admin (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS purchase (
+        id INTEGER NOT NULL,
+        agent_id INTEGER,
+        amount FLOAT NOT NULL,
+        note TEXT,
+        date DATE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(agent_id) REFERENCES agent (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS task (
+        id INTEGER NOT NULL,
+        title VARCHAR(200) NOT NULL,
+        description TEXT,
+        agent_id INTEGER,
+        assigned_at DATETIME,
+        due_date DATE,
+        completed BOOLEAN,
+        completed_at DATETIME,
+        income_id INTEGER,
+        car_count INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(agent_id) REFERENCES agent (id),
+        FOREIGN KEY(income_id) REFERENCES income (id)
+    )""",
+)
+
+
+def upgrade(conn):
+    for ddl in BASELINE:
+        conn.exec_driver_sql(ddl)
+
+    add_missing_columns(conn, 'agent', [
+        ('username', 'TEXT'),
+        ('password_hash', 'TEXT'),
+        ('is_active', 'INTEGER DEFAULT 1'),
+    ])
+    conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS idx_agent_username ON agent(username) WHERE username IS NOT NULL")
+
+    add_missing_columns(conn, 'income', [
+        ('agent_id', 'INTEGER'),
+        ('customer_name', 'TEXT'),
+        ('service_type', 'TEXT'),
+        ('car_type', 'TEXT'),
+        ('invoice_number', 'TEXT'),
+    ])
+
+    add_missing_columns(conn, 'task', [
+        ('completed', 'INTEGER DEFAULT 0'),
+        ('completed_at', 'TEXT'),
+        ('income_id', 'INTEGER'),
+        ('car_count', 'INTEGER DEFAULT 0'),
+    ])
+
+    if conn.exec_driver_sql("SELECT 1 FROM admin WHERE username = 'admin'").first() is None:
+        conn.exec_driver_sql(
+            "INSERT INTO admin (username, password_hash) VALUES (?, ?)",
+            ('admin', generate_password_hash('admin123')),
+        )
@@ -0,0 +1,69 @@
+"""Ledger indexes and the per-agent monthly rollup table.
+
+Creates the composite indexes on the ledger tables and backfills
+agent_month_rollup from the existing rows.
+"""
+from migrations import execute_all
+
+
+DDL = (
+    """CREATE TABLE IF NOT EXISTS agent_month_rollup (
+        id INTEGER NOT NULL,
+        agent_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        income_sum FLOAT NOT NULL,
+        income_count INTEGER NOT NULL,
+        purchase_sum FLOAT NOT NULL,
+        purchase_count INTEGER NOT NULL,
+        tasks_completed INTEGER NOT NULL,
+        cars_wrapped INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        CONSTRAINT uq_rollup_agent_month UNIQUE (agent_id, year, month)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_rollup_month ON agent_month_rollup (year, month)",
+    "CREATE INDEX IF NOT EXISTS ix_income_agent_date ON income (agent_id, date)",
+    "CREATE INDEX IF NOT EXISTS ix_income_date ON income (date)",
+    "CREATE INDEX IF NOT EXISTS ix_purchase_agent_date ON purchase (agent_id, date)",
+    "CREATE INDEX IF NOT EXISTS ix_purchase_date ON purchase (date)",
+    "CREATE INDEX IF NOT EXISTS ix_task_agent_completed ON task (agent_id, completed, completed_at)",
+    "CREATE INDEX IF NOT EXISTS ix_task_assigned_at ON task (assigned_at)",
+    "CREATE INDEX IF NOT EXISTS ix_task_income_id ON task (income_id)",
+    "CREATE INDEX IF NOT EXISTS ix_log_created_at ON log (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_monthly_target_month_agent ON monthly_target (year, month, agent_id)",
+)
+
+# Rows without an agent are kept under agent 0, undated rows under year/month 0
+BACKFILL = """
+INSERT INTO agent_month_rollup (agent_id, year, month, income_sum, income_count, purchase_sum,
+                                purchase_count, tasks_completed, cars_wrapped)
+SELECT agent_id, year, month, SUM(income_sum), SUM(income_count), SUM(purchase_sum),
+       SUM(purchase_count), SUM(tasks_completed), SUM(cars_wrapped)
+FROM (
+    SELECT COALESCE(agent_id, 0) AS agent_id,
+           COALESCE(CAST(strftime('%Y', date) AS INTEGER), 0) AS year,
+           COALESCE(CAST(strftime('%m', date) AS INTEGER), 0) AS month,
+           COALESCE(SUM(amount), 0) AS income_sum, COUNT(id) AS income_count,
+           0 AS purchase_sum, 0 AS purchase_count, 0 AS tasks_completed, 0 AS cars_wrapped
+    FROM income GROUP BY 1, 2, 3
+    UNION ALL
+    SELECT COALESCE(agent_id, 0),
+           COALESCE(CAST(strftime('%Y', date) AS INTEGER), 0),
+           COALESCE(CAST(strftime('%m', date) AS INTEGER), 0),
+           0, 0, COALESCE(SUM(amount), 0), COUNT(id), 0, 0
+    FROM purchase GROUP BY 1, 2, 3
+    UNION ALL
+    SELECT COALESCE(agent_id, 0),
+           COALESCE(CAST(strftime('%Y', completed_at) AS INTEGER), 0),
+           COALESCE(CAST(strftime('%m', completed_at) AS INTEGER), 0),
+           0, 0, 0, 0, COUNT(id), COALESCE(SUM(car_count), 0)
+    FROM task WHERE completed = 1 GROUP BY 1, 2, 3
+)
+GROUP BY agent_id, year, month
+"""
+
+
+def upgrade(conn):
+    execute_all(conn, DDL)
+    conn.exec_driver_sql("DELETE FROM agent_month_rollup")
+    conn.exec_driver_sql(BACKFILL)
@@ -0,0 +1,29 @@
+"""Background spreadsheet import jobs."""
+from migrations import execute_all
+
+
+DDL = (
+    """CREATE TABLE IF NOT EXISTS import_job (
+        id INTEGER NOT NULL,
+        file_id INTEGER,
+        filename VARCHAR(300) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        total_rows INTEGER,
+        processed_rows INTEGER,
+        summary TEXT,
+        rejected TEXT,
+        error TEXT,
+        created_by INTEGER,
+        created_at DATETIME,
+        started_at DATETIME,
+        finished_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(file_id) REFERENCES file_upload (id),
+        FOREIGN KEY(created_by) REFERENCES admin (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_import_job_status ON import_job (status)",
+)
+
+
+def upgrade(conn):
+    execute_all(conn, DDL)
@@ -0,0 +1,27 @@
+"""Content digests on uploads and row-level import keys.
+
+Adds size/digest/stored_name to file_upload and an import_key to the
+tables the spreadsheet importer writes, with the indexes that make
+duplicate uploads and re-imported rows cheap to detect.
+"""
+from migrations import add_missing_columns, execute_all
+
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_file_upload_digest ON file_upload (digest)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_agent_import_key ON agent (import_key)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_purchase_import_key ON purchase (import_key)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_income_import_key ON income (import_key)",
+    "CREATE INDEX IF NOT EXISTS ix_import_job_file_id ON import_job (file_id)",
+)
+
+
+def upgrade(conn):
+    add_missing_columns(conn, 'file_upload', [
+        ('stored_name', 'VARCHAR(300)'),
+        ('size', 'INTEGER'),
+        ('digest', 'VARCHAR(64)'),
+    ])
+    for table in ('agent', 'purchase', 'income'):
+        add_missing_columns(conn, table, [('import_key', 'VARCHAR(40)')])
+    execute_all(conn, INDEXES)
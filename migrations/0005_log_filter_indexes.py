@@ -0,0 +1,12 @@
+"""Indexes for the filtered, keyset-paginated /logs viewer."""
+from migrations import execute_all
+
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_log_action_created ON log (action, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_log_user_created ON log (created_by, created_at)",
+)
+
+
+def upgrade(conn):
+    execute_all(conn, INDEXES)
@@ -0,0 +1,23 @@
+"""Store API tokens as SHA-256 digests and track their usage.
+
+Existing tokens keep working: their plaintext value is replaced by its
+digest, which is what the API now looks up.
+"""
+import hashlib
+
+from sqlalchemy import text
+
+from migrations import add_missing_columns
+
+
+def upgrade(conn):
+    add_missing_columns(conn, 'api_token', [
+        ('use_count', 'INTEGER DEFAULT 0'),
+        ('last_used_at', 'DATETIME'),
+    ])
+    rows = conn.execute(text("SELECT id, token FROM api_token WHERE length(token) != 64")).all()
+    for token_id, token in rows:
+        conn.execute(
+            text("UPDATE api_token SET token = :digest WHERE id = :id"),
+            {'digest': hashlib.sha256(token.encode()).hexdigest(), 'id': token_id},
+        )
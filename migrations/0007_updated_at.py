@@ -0,0 +1,18 @@
+"""updated_at on agents and tasks, for the API's updated_since filter and
+conditional responses. Existing rows get their creation time."""
+from migrations import add_missing_columns, execute_all
+
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_agent_updated_at ON agent (updated_at)",
+    "CREATE INDEX IF NOT EXISTS ix_task_due_date ON task (due_date)",
+    "CREATE INDEX IF NOT EXISTS ix_task_updated_at ON task (updated_at)",
+)
+
+
+def upgrade(conn):
+    add_missing_columns(conn, 'agent', [('updated_at', 'DATETIME')])
+    add_missing_columns(conn, 'task', [('updated_at', 'DATETIME')])
+    conn.exec_driver_sql("UPDATE agent SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL")
+    conn.exec_driver_sql("UPDATE task SET updated_at = COALESCE(completed_at, assigned_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL")
+    execute_all(conn, INDEXES)
@@ -0,0 +1,55 @@
+"""Change log behind /api/changes: the change_log and change_feed tables,
+the triggers on task, income and purchase, and an insert entry for every
+existing row."""
+from migrations import execute_all
+
+
+TABLES = ('task', 'income', 'purchase')
+
+DDL = (
+    """CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        table_name VARCHAR(20) NOT NULL,
+        row_id INTEGER NOT NULL,
+        op VARCHAR(1) NOT NULL,
+        changed_at DATETIME NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_change_log_row ON change_log (table_name, row_id)",
+    "CREATE INDEX IF NOT EXISTS ix_change_log_op_changed ON change_log (op, changed_at)",
+    """CREATE TABLE IF NOT EXISTS change_feed (
+        id INTEGER NOT NULL,
+        pruned_through INTEGER NOT NULL,
+        pruned_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    "INSERT OR IGNORE INTO change_feed (id, pruned_through) VALUES (1, 0)",
+)
+
+# The previous entry is deleted rather than replaced with INSERT OR REPLACE:
+# an outer INSERT OR IGNORE would override the trigger's conflict clause and
+# silently keep the stale entry.
+TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS change_log_{table}_{event} AFTER {EVENT} ON {table}
+BEGIN
+    DELETE FROM change_log WHERE table_name = '{table}' AND row_id = {ref}.id;
+    INSERT INTO change_log (table_name, row_id, op, changed_at)
+    VALUES ('{table}', {ref}.id, '{op}', CURRENT_TIMESTAMP);
+END
+"""
+
+BACKFILL = (
+    "INSERT INTO change_log (table_name, row_id, op, changed_at) "
+    "SELECT '{table}', id, 'I', CURRENT_TIMESTAMP FROM {table} "
+    "WHERE id NOT IN (SELECT row_id FROM change_log WHERE table_name = '{table}') ORDER BY id"
+)
+
+
+def upgrade(conn):
+    execute_all(conn, DDL)
+    # every existing row gets an insert entry, so since=0 covers it
+    execute_all(conn, (BACKFILL.format(table=table) for table in TABLES))
+    execute_all(conn, (
+        TRIGGER.format(table=table, event=event, EVENT=event.upper(), op=op, ref=ref)
+        for table in TABLES
+        for event, op, ref in (('insert', 'I', 'NEW'), ('update', 'U', 'NEW'), ('delete', 'D', 'OLD'))
+    ))
@@ -0,0 +1,9 @@
+"""Counter table for invoice numbers (see invoices.py)."""
+
+
+def upgrade(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS invoice_counter ("
+        "name VARCHAR(40) NOT NULL, next_value INTEGER NOT NULL, PRIMARY KEY (name))"
+    )
+    conn.exec_driver_sql("INSERT OR IGNORE INTO invoice_counter (name, next_value) VALUES ('invoice', 1)")
@@ -0,0 +1,12 @@
+"""Indexes for the filtered, keyset-paginated /tasks list."""
+from migrations import execute_all
+
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_task_agent_assigned ON task (agent_id, assigned_at)",
+    "CREATE INDEX IF NOT EXISTS ix_task_completed_assigned ON task (completed, assigned_at)",
+)
+
+
+def upgrade(conn):
+    execute_all(conn, INDEXES)
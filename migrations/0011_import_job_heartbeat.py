@@ -0,0 +1,8 @@
+"""Heartbeat on import jobs, so jobs orphaned by a stopped worker can be
+told apart from live ones. Existing unfinished jobs get their start time."""
+from migrations import add_missing_columns
+
+
+def upgrade(conn):
+    add_missing_columns(conn, 'import_job', [('heartbeat_at', 'DATETIME')])
+    conn.exec_driver_sql("UPDATE import_job SET heartbeat_at = COALESCE(started_at, created_at) WHERE heartbeat_at IS NULL")
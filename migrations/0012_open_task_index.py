@@ -0,0 +1,7 @@
+"""Covering index for the per-agent open/overdue task counts. Tasks stored
+without a completed flag are marked open so the index finds them."""
+
+
+def upgrade(conn):
+    conn.exec_driver_sql("UPDATE task SET completed = 0 WHERE completed IS NULL")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_task_open_due ON task (completed, agent_id, due_date)")
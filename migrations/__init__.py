@@ -0,0 +1,80 @@
+"""Versioned schema migrations.
+
+Each migration is a module in this package named ``NNNN_description.py``
+with an ``upgrade(conn)`` function. Applied versions are recorded in the
+``schema_version`` table; ``flask db-upgrade`` applies the pending ones in
+order, each in its own transaction. Run it once per deploy, before the
+workers are (re)started.
+"""
+import importlib
+import os
+import pkgutil
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+
+_NAME = re.compile(r'^(\d{4})_\w+$')
+
+
+def available():
+    """Return [(version, module_name)] for every migration script, in order"""
+    found = []
+    for info in pkgutil.iter_modules([os.path.dirname(__file__)]):
+        match = _NAME.match(info.name)
+        if match:
+            found.append((int(match.group(1)), info.name))
+    return sorted(found)
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT NOT NULL)"
+    ))
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+
+def upgrade(engine):
+    """Apply every pending migration; returns the names that were applied"""
+    applied = []
+    for version, name in available():
+        with engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            module = importlib.import_module(f'{__name__}.{name}')
+            module.upgrade(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {'v': version, 'n': name, 't': datetime.utcnow().isoformat(' ', 'seconds')},
+            )
+        applied.append(name)
+    return applied
+
+
+def column_names(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})").fetchall()}
+
+
+def add_missing_columns(conn, table, columns):
+    """ALTER TABLE ADD COLUMN for each (name, ddl) pair the table lacks"""
+    existing = column_names(conn, table)
+    for name, ddl in columns:
+        if name not in existing:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+
+def execute_all(conn, statements):
+    """Run a migration's DDL statements in order.
+
+    Migrations spell out their tables and indexes as they were when the
+    migration was written, never from the current models, so that every
+    version is the same schema step on every database.
+    """
+    for statement in statements:
+        conn.exec_driver_sql(statement)
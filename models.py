@@ -25,6 +25,9 @@ class Agent(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True)
     password_hash = db.Column(db.String(200))
     is_active = db.Column(db.Boolean, default=True)
+    # Set on rows created by the spreadsheet importer, so re-imports skip them
+    import_key = db.Column(db.String(40), unique=True, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     def get_id(self):
         return f"agent:{self.id}"
@@ -34,12 +37,25 @@ class Task(db.Model):
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'))
-    assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
-    due_date = db.Column(db.Date)
+    assigned_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    due_date = db.Column(db.Date, index=True)
     completed = db.Column(db.Boolean, default=False)
     completed_at = db.Column(db.DateTime)
-    income_id = db.Column(db.Integer, db.ForeignKey('income.id'))
+    income_id = db.Column(db.Integer, db.ForeignKey('income.id'), index=True)
     car_count = db.Column(db.Integer, default=0)  # عدد السيارات المغلفة
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    # No backref: deleting an agent must not load and null out its rows
+    agent = db.relationship('Agent', foreign_keys=[agent_id])
+
+    # The /tasks list pages on (assigned_at, id), per agent and by status;
+    # ix_task_open_due covers the per-agent open/overdue counts
+    __table_args__ = (
+        db.Index('ix_task_agent_completed', 'agent_id', 'completed', 'completed_at'),
+        db.Index('ix_task_agent_assigned', 'agent_id', 'assigned_at'),
+        db.Index('ix_task_completed_assigned', 'completed', 'assigned_at'),
+        db.Index('ix_task_open_due', 'completed', 'agent_id', 'due_date'),
+    )
 
 
 class MonthlyTarget(db.Model):
@@ -55,18 +71,70 @@ class MonthlyTarget(db.Model):
     # Relationship to agent
     agent = db.relationship('Agent', backref='monthly_targets', foreign_keys=[agent_id])
 
+    # Month first so the per-month lookup on /tasks can use it too
+    __table_args__ = (
+        db.Index('ix_monthly_target_month_agent', 'year', 'month', 'agent_id'),
+    )
+
 class FileUpload(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(300), nullable=False)
     uploaded_by = db.Column(db.Integer, db.ForeignKey('admin.id'))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Content-addressed copy on disk: <sha256>.<ext> in UPLOAD_FOLDER
+    stored_name = db.Column(db.String(300))
+    size = db.Column(db.Integer)
+    digest = db.Column(db.String(64), index=True)
+
+    @property
+    def storage_name(self):
+        # Files uploaded before content addressing are stored under their own name
+        return self.stored_name or self.filename
+
+class ImportJob(db.Model):
+    """Background spreadsheet import; status is one of queued/running/done/failed"""
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.Integer, db.ForeignKey('file_upload.id'), index=True)
+    filename = db.Column(db.String(300), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    total_rows = db.Column(db.Integer, default=0)
+    processed_rows = db.Column(db.Integer, default=0)
+    summary = db.Column(db.Text)
+    rejected = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_by = db.Column(db.Integer, db.ForeignKey('admin.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # refreshed while the job is queued or running; see jobs.active()
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'total_rows': self.total_rows or 0,
+            'processed_rows': self.processed_rows or 0,
+            'progress': min(100, round(100 * (self.processed_rows or 0) / self.total_rows)) if self.total_rows else (100 if self.status == 'done' else 0),
+            'summary': self.summary,
+            'rejected': self.rejected,
+            'error': self.error,
+        }
 
 class Purchase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'))
     amount = db.Column(db.Float, nullable=False)
     note = db.Column(db.Text)
-    date = db.Column(db.Date, default=datetime.utcnow)
+    date = db.Column(db.Date, default=datetime.utcnow, index=True)
+    import_key = db.Column(db.String(40), unique=True, index=True)
+
+    agent = db.relationship('Agent', foreign_keys=[agent_id])
+
+    __table_args__ = (
+        db.Index('ix_purchase_agent_date', 'agent_id', 'date'),
+    )
 
 class Income(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -77,8 +145,22 @@ class Income(db.Model):
     service_type = db.Column(db.String(200))
     car_type = db.Column(db.String(200))
     note = db.Column(db.Text)
-    date = db.Column(db.Date, default=datetime.utcnow)
+    date = db.Column(db.Date, default=datetime.utcnow, index=True)
     invoice_number = db.Column(db.String(50), unique=True)
+    import_key = db.Column(db.String(40), unique=True, index=True)
+
+    agent = db.relationship('Agent', foreign_keys=[agent_id])
+
+    __table_args__ = (
+        db.Index('ix_income_agent_date', 'agent_id', 'date'),
+    )
+
+
+class InvoiceCounter(db.Model):
+    """Next unallocated invoice sequence number (see invoices.py)"""
+    __tablename__ = 'invoice_counter'
+    name = db.Column(db.String(40), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
 
 
 class ServiceType(db.Model):
@@ -98,13 +180,76 @@ class Log(db.Model):
     action = db.Column(db.String(200))
     detail = db.Column(db.Text)
     created_by = db.Column(db.Integer, db.ForeignKey('admin.id'))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    # The /logs viewer pages on (created_at, id); SQLite appends the rowid
+    # (id) to every index, so these also serve the filtered keyset scans.
+    __table_args__ = (
+        db.Index('ix_log_action_created', 'action', 'created_at'),
+        db.Index('ix_log_user_created', 'created_by', 'created_at'),
+    )
 
 
 class APIToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
-    token = db.Column(db.String(128), unique=True, nullable=False)
+    # SHA-256 hex digest of the token; the token itself is shown once and never stored
+    token_digest = db.Column('token', db.String(128), unique=True, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('admin.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     revoked = db.Column(db.Boolean, default=False)
+    # Written in batches by api_auth.flush_usage()
+    use_count = db.Column(db.Integer, default=0)
+    last_used_at = db.Column(db.DateTime)
+
+
+class ChangeLog(db.Model):
+    """Latest change of each Task, Income and Purchase row, for /api/changes.
+
+    Written by SQLite triggers (see changes.py), so ORM, Core and raw SQL
+    writes are all captured. Each write replaces the row's previous entry
+    with a new, higher ``seq``; AUTOINCREMENT keeps seq values from being
+    reused after entries are deleted.
+    """
+    __tablename__ = 'change_log'
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(20), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(1), nullable=False)  # I / U / D
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_change_log_row', 'table_name', 'row_id', unique=True),
+        db.Index('ix_change_log_op_changed', 'op', 'changed_at'),
+        {'sqlite_autoincrement': True},
+    )
+
+
+class ChangeFeed(db.Model):
+    """Single row: the highest seq whose delete entries have been pruned"""
+    __tablename__ = 'change_feed'
+    id = db.Column(db.Integer, primary_key=True)
+    pruned_through = db.Column(db.Integer, nullable=False, default=0)
+    pruned_at = db.Column(db.DateTime)
+
+
+class AgentMonthRollup(db.Model):
+    """Per-agent monthly totals, maintained by rollups.py on every ledger write.
+
+    agent_id 0 holds rows without an agent; year/month 0 holds undated rows.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    agent_id = db.Column(db.Integer, nullable=False, default=0)
+    year = db.Column(db.Integer, nullable=False, default=0)
+    month = db.Column(db.Integer, nullable=False, default=0)
+    income_sum = db.Column(db.Float, nullable=False, default=0)
+    income_count = db.Column(db.Integer, nullable=False, default=0)
+    purchase_sum = db.Column(db.Float, nullable=False, default=0)
+    purchase_count = db.Column(db.Integer, nullable=False, default=0)
+    tasks_completed = db.Column(db.Integer, nullable=False, default=0)
+    cars_wrapped = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('agent_id', 'year', 'month', name='uq_rollup_agent_month'),
+        db.Index('ix_rollup_month', 'year', 'month'),
+    )
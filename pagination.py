@@ -0,0 +1,106 @@
+"""Keyset (cursor) pagination for newest-first listings.
+
+Pages are selected with a row-value comparison on the sort key, e.g.
+``(created_at, id) < (:created_at, :id)``, instead of OFFSET, so each
+page costs one index range scan of ``per_page + 1`` rows however deep
+it is. No total count is computed; the extra row tells whether another
+page exists.
+"""
+from datetime import date, datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    return '~'.join(v.isoformat() if isinstance(v, (date, datetime)) else str(v) for v in values)
+
+
+def decode_cursor(text, columns):
+    """Parse a cursor for the given key columns; returns None if it is malformed"""
+    parts = (text or '').split('~')
+    if len(parts) != len(columns):
+        return None
+    values = []
+    try:
+        for part, column in zip(parts, columns):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                values.append(datetime.fromisoformat(part))
+            elif python_type is date:
+                values.append(date.fromisoformat(part))
+            else:
+                values.append(python_type(part))
+    except (ValueError, NotImplementedError):
+        return None
+    return tuple(values)
+
+
+def keyset_page(query, columns, per_page, before=None, after=None):
+    """Return one page of ``query`` ordered by ``columns`` descending.
+
+    ``before`` / ``after`` are cursor strings from a previous page: the
+    page of older rows after that cursor, or of newer rows before it. The
+    result is ``{'items', 'older', 'newer'}``; ``older`` and ``newer`` are
+    the cursors for the neighbouring pages, or None when there is none.
+    The columns must together be unique (end with the primary key).
+    """
+    key = tuple_(*columns)
+    older_than = decode_cursor(before, columns) if before else None
+    newer_than = decode_cursor(after, columns) if after else None
+
+    if newer_than is not None:
+        rows = query.filter(key > tuple_(*newer_than)).order_by(*(c.asc() for c in columns)).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return {
+            'items': items,
+            'older': _cursor(items[-1], columns) if items else None,
+            'newer': _cursor(items[0], columns) if has_more else None,
+        }
+
+    if older_than is not None:
+        query = query.filter(key < tuple_(*older_than))
+    rows = query.order_by(*(c.desc() for c in columns)).limit(per_page + 1).all()
+    items = rows[:per_page]
+    return {
+        'items': items,
+        'older': _cursor(items[-1], columns) if len(rows) > per_page else None,
+        'newer': _cursor(items[0], columns) if older_than is not None and items else None,
+    }
+
+
+def _cursor(row, columns):
+    return encode_cursor(getattr(row, c.key) for c in columns)
+
+
+def list_page(rows, keys, per_page, before=None, after=None):
+    """keyset_page() for an in-memory list of dicts sorted ascending by ``keys``"""
+    key = lambda row: tuple(row[k] for k in keys)
+    kinds = [type(v) for v in key(rows[0])] if rows else []
+
+    def decode(text):
+        parts = (text or '').split('~')
+        if not rows or len(parts) != len(keys):
+            return None
+        try:
+            return tuple(k.fromisoformat(p) if k in (date, datetime) else k(p) for k, p in zip(kinds, parts))
+        except ValueError:
+            return None
+
+    older_than = decode(before) if before else None
+    newer_than = decode(after) if after else None
+    if newer_than is not None:
+        newer = [r for r in rows if key(r) > newer_than]
+        items = newer[:per_page][::-1]
+        return {
+            'items': items,
+            'older': encode_cursor(key(items[-1])) if items else None,
+            'newer': encode_cursor(key(items[0])) if len(newer) > per_page else None,
+        }
+    older = [r for r in rows if older_than is None or key(r) < older_than]
+    items = older[::-1][:per_page]
+    return {
+        'items': items,
+        'older': encode_cursor(key(items[-1])) if len(older) > per_page else None,
+        'newer': encode_cursor(key(items[0])) if older_than is not None and items else None,
+    }
@@ -0,0 +1,69 @@
+"""Password hashing for bulk agent creation.
+
+Werkzeug's default hash is deliberately slow (pbkdf2, 600k iterations), so
+hashing one password per agent on the request or import thread caps bulk
+creation at one core. Batches are hashed on a bounded process pool
+(HASH_WORKERS processes, default: one per CPU); single hashes and one-CPU
+hosts hash inline, where a pool would only add overhead.
+"""
+import atexit
+import multiprocessing
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+
+_app = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_app(app):
+    global _app
+    _app = app
+    atexit.register(shutdown)
+
+
+def _workers():
+    return max(1, _app.config.get('HASH_WORKERS', 1))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the app process has DB connections and worker threads, which fork would copy
+            _pool = ProcessPoolExecutor(max_workers=_workers(), mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def shutdown():
+    """Stop the pool; the next batch starts a new one sized from HASH_WORKERS"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def hash_many(passwords):
+    """Hash a list of passwords, in parallel when there is more than one"""
+    passwords = list(passwords)
+    workers = _workers()
+    if len(passwords) < 2 or workers < 2:
+        return [generate_password_hash(p) for p in passwords]
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return list(_get_pool().map(generate_password_hash, passwords, chunksize=chunksize))
+
+
+def new_credentials(count):
+    """Return ``count`` (temporary password, hash) pairs"""
+    plain = [secrets.token_urlsafe(8) for _ in range(count)]
+    return list(zip(plain, hash_many(plain)))
+
+
+def new_credential():
+    """Return one (temporary password, hash) pair"""
+    return new_credentials(1)[0]
@@ -0,0 +1,194 @@
+"""Incrementally maintained per-agent monthly rollups.
+
+A ``before_flush`` hook turns every insert, update and delete of Income,
+Purchase and Task into deltas on AgentMonthRollup. The deltas are written on
+the flush's own connection, so a rollup change commits or rolls back together
+with the ledger change that caused it.
+"""
+from collections import defaultdict
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import db, Income, Purchase, Task, AgentMonthRollup
+
+
+FIELDS = ('income_sum', 'income_count', 'purchase_sum', 'purchase_count', 'tasks_completed', 'cars_wrapped')
+
+# Columns that feed the rollup, per tracked model
+TRACKED = {
+    Income: ('agent_id', 'amount', 'date'),
+    Purchase: ('agent_id', 'amount', 'date'),
+    Task: ('agent_id', 'completed', 'completed_at', 'car_count'),
+}
+
+
+def _agent_key(value):
+    try:
+        return int(value) if value not in (None, '') else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def _period(value):
+    if value is None:
+        return 0, 0
+    return value.year, value.month
+
+
+def _contribution(model, values):
+    """Return (key, deltas) for one row's values, or None if it adds nothing"""
+    if model is Task:
+        if not values['completed']:
+            return None
+        key = (_agent_key(values['agent_id']),) + _period(values['completed_at'])
+        return key, {'tasks_completed': 1, 'cars_wrapped': values['car_count'] or 0}
+    prefix = 'income' if model is Income else 'purchase'
+    key = (_agent_key(values['agent_id']),) + _period(values['date'])
+    return key, {f'{prefix}_sum': values['amount'] or 0, f'{prefix}_count': 1}
+
+
+def _column_default(model, key):
+    default = model.__table__.c[key].default
+    if default is None:
+        return None
+    return default.arg(None) if default.is_callable else default.arg
+
+
+def _pending_values(obj, model):
+    """Values a pending object will be inserted with.
+
+    The ORM leaves None-valued columns out of the INSERT when they have a
+    default, so the default applies to those as well.
+    """
+    values = {}
+    for key in TRACKED[model]:
+        value = getattr(obj, key)
+        values[key] = _column_default(model, key) if value is None else value
+    return values
+
+
+def _current_values(obj, model):
+    return {key: getattr(obj, key) for key in TRACKED[model]}
+
+
+def _committed_values(session, obj, model):
+    """Values currently stored in the database for a persistent object"""
+    state = inspect(obj)
+    values = {}
+    for key in TRACKED[model]:
+        hist = state.attrs[key].history
+        if hist.deleted:
+            values[key] = hist.deleted[0]
+        elif hist.unchanged:
+            values[key] = hist.unchanged[0]
+        elif not hist.added:
+            values[key] = getattr(obj, key)
+        else:
+            # Attribute was replaced without its old value being loaded
+            cols = [model.__table__.c[k] for k in TRACKED[model]]
+            row = session.connection().execute(
+                select(*cols).where(model.__table__.c.id == state.identity[0])
+            ).mappings().first()
+            return dict(row) if row else None
+    return values
+
+
+def _accumulate(deltas, model, values, sign):
+    if values is None:
+        return
+    contribution = _contribution(model, values)
+    if contribution is None:
+        return
+    key, changes = contribution
+    for field, value in changes.items():
+        deltas[key][field] += sign * value
+
+
+def apply_deltas(connection, deltas):
+    """Upsert accumulated deltas into the rollup table"""
+    rows = []
+    for (agent_id, year, month), changes in deltas.items():
+        if any(changes.values()):
+            rows.append(dict(agent_id=agent_id, year=year, month=month, **changes))
+    if not rows:
+        return
+    table = AgentMonthRollup.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['agent_id', 'year', 'month'],
+        set_={f: table.c[f] + stmt.excluded[f] for f in FIELDS},
+    )
+    connection.execute(stmt, rows)
+
+
+def new_deltas():
+    return defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    deltas = new_deltas()
+    for obj in session.new:
+        model = type(obj)
+        if model in TRACKED:
+            _accumulate(deltas, model, _pending_values(obj, model), 1)
+    for obj in session.dirty:
+        model = type(obj)
+        if model in TRACKED and session.is_modified(obj):
+            _accumulate(deltas, model, _committed_values(session, obj, model), -1)
+            _accumulate(deltas, model, _current_values(obj, model), 1)
+    for obj in session.deleted:
+        model = type(obj)
+        if model in TRACKED:
+            _accumulate(deltas, model, _committed_values(session, obj, model), -1)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def _year_month(column):
+    year = db.func.coalesce(db.cast(db.func.strftime('%Y', column), db.Integer), 0)
+    month = db.func.coalesce(db.cast(db.func.strftime('%m', column), db.Integer), 0)
+    return year, month
+
+
+def rebuild(connection):
+    """Recompute the whole rollup table from the ledger; returns the row count.
+
+    Runs on the given connection; the caller owns the transaction.
+    """
+    deltas = new_deltas()
+    sources = (
+        (Income, Income.date, None, ('income_sum', db.func.sum(Income.amount)), ('income_count', db.func.count(Income.id))),
+        (Purchase, Purchase.date, None, ('purchase_sum', db.func.sum(Purchase.amount)), ('purchase_count', db.func.count(Purchase.id))),
+        (Task, Task.completed_at, Task.completed == True, ('tasks_completed', db.func.count(Task.id)), ('cars_wrapped', db.func.sum(Task.car_count))),
+    )
+    for model, period_col, condition, *fields in sources:
+        year, month = _year_month(period_col)
+        query = select(model.agent_id, year, month, *(agg for _, agg in fields))
+        if condition is not None:
+            query = query.where(condition)
+        for agent_id, y, m, *values in connection.execute(query.group_by(model.agent_id, year, month)):
+            key = (_agent_key(agent_id), y, m)
+            for (field, _), value in zip(fields, values):
+                deltas[key][field] += value or 0
+    connection.execute(AgentMonthRollup.__table__.delete())
+    apply_deltas(connection, deltas)
+    return len(deltas)
+
+
+def apply_rows(connection, model, rows):
+    """Apply rollup deltas for rows inserted in bulk, outside the ORM flush.
+
+    ``rows`` are the column dicts that were inserted; missing or None values
+    are treated like the ORM treats them, i.e. the column default applies.
+    """
+    deltas = new_deltas()
+    for row in rows:
+        values = {}
+        for key in TRACKED[model]:
+            value = row.get(key)
+            values[key] = _column_default(model, key) if value is None else value
+        _accumulate(deltas, model, values, 1)
+    apply_deltas(connection, deltas)
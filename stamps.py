@@ -0,0 +1,22 @@
+"""Cross-process invalidation stamps for in-memory caches.
+
+A stamp is the mtime of a small file. Writers bump it after a change;
+each worker compares it on lookup (a single stat call, no database query)
+and drops its cache when it moved.
+"""
+import os
+import time
+
+
+def read(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump(path):
+    with open(path, 'a'):
+        pass
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
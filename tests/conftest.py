@@ -0,0 +1,129 @@
+"""Shared fixtures: the app on a migrated temporary SQLite database.
+
+The environment is set before ``app`` is imported, so nothing touches the
+real database, upload folder or cache stamps. The schema is migrated once;
+each test starts from a copy of that database.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp(prefix='app-tests-')
+DB_PATH = os.path.join(TMP, 'app.db')
+os.environ.update({
+    'DATABASE_URL': f'sqlite:///{DB_PATH}',
+    'AUDIT_ASYNC': '0',
+    'USER_CACHE_STAMP': os.path.join(TMP, 'user-cache-stamp'),
+    'API_TOKEN_CACHE_STAMP': os.path.join(TMP, 'api-token-cache-stamp'),
+    'CATALOG_CACHE_STAMP': os.path.join(TMP, 'catalog-cache-stamp'),
+    'INVOICE_CACHE_FOLDER': os.path.join(TMP, 'invoices'),
+    'LOG_ARCHIVE_FOLDER': os.path.join(TMP, 'archive'),
+})
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app as flask_app  # noqa: E402
+from models import db, Agent, Income, Purchase, Task  # noqa: E402
+import api_auth  # noqa: E402
+import catalog  # noqa: E402
+import identity  # noqa: E402
+import invoices  # noqa: E402
+import migrations  # noqa: E402
+
+TEMPLATE_DB = os.path.join(TMP, 'migrated.db')
+AGENT_PASSWORD = 'agent-pass'
+
+
+@pytest.fixture(scope='session')
+def _migrated():
+    flask_app.config.update(TESTING=True, UPLOAD_FOLDER=os.path.join(TMP, 'uploads'))
+    os.makedirs(flask_app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with flask_app.app_context():
+        migrations.upgrade(db.engine)
+        db.engine.dispose()
+    shutil.copy(DB_PATH, TEMPLATE_DB)
+    yield
+    shutil.rmtree(TMP, ignore_errors=True)
+
+
+@pytest.fixture
+def app(_migrated):
+    saved_config = dict(flask_app.config)
+    with flask_app.app_context():
+        db.engine.dispose()
+        shutil.copy(TEMPLATE_DB, DB_PATH)
+        shutil.rmtree(flask_app.config['INVOICE_CACHE_FOLDER'], ignore_errors=True)
+        identity.invalidate()
+        catalog.invalidate()
+        api_auth.invalidate()
+        invoices._block = iter(())
+        yield flask_app
+        db.session.remove()
+    flask_app.config.clear()
+    flask_app.config.update(saved_config)
+
+
+@pytest.fixture
+def seed(app):
+    """seed(agents, rows): agents a0, a1, ... and ``rows`` incomes, purchases and tasks spread over a year.
+
+    Calling it again adds more agents and rows after the existing ones.
+    """
+    def seed(agents=3, rows=30):
+        password_hash = generate_password_hash(AGENT_PASSWORD, method='pbkdf2:sha256:1')
+        first = Agent.query.count()
+        db.session.add_all(Agent(name=f'Agent {i}', username=f'a{i}', password_hash=password_hash)
+                           for i in range(first, first + agents))
+        db.session.commit()
+        agent_ids = [agent_id for (agent_id,) in db.session.query(Agent.id).order_by(Agent.id)]
+        offset = Income.query.count()
+        today = date.today()
+        for j in range(offset, offset + rows):
+            agent_id = agent_ids[j % len(agent_ids)]
+            day = today - timedelta(days=(j * 37) % 365)
+            done = j % 2 == 0
+            db.session.add(Income(agent_id=agent_id, amount=100 + j, date=day, invoice_number=f'T-{j}', source='seed'))
+            db.session.add(Purchase(agent_id=agent_id, amount=10 + j, date=day, note='seed'))
+            db.session.add(Task(title=f'Task {j}', agent_id=agent_id, due_date=day, car_count=j % 3, completed=done,
+                                completed_at=datetime.combine(day, datetime.min.time()) if done else None))
+        db.session.commit()
+    return seed
+
+
+def login(client, username='admin', password='admin123'):
+    """Log a test client in as the admin, or as an agent when ``username`` is an agent's"""
+    if username == 'admin':
+        response = client.post('/login', data={'username': username, 'password': password})
+    else:
+        response = client.post('/agent/login', data={'username': username, 'password': AGENT_PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def admin_client(app):
+    return login(app.test_client())
+
+
+@contextmanager
+def recorded_queries():
+    """Collect (statement, parameters) for every query run inside the block"""
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
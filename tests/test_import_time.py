@@ -0,0 +1,39 @@
+"""Worker start-up budget: ``import app`` stays cheap and leaves pandas unloaded.
+
+Each measurement runs in a fresh interpreter, since this process has
+already imported the app. IMPORT_BUDGET_SECONDS raises the bound on slow
+machines.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+BUDGET_SECONDS = float(os.getenv('IMPORT_BUDGET_SECONDS', 1.5))
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl')
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_import():
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=os.environ.copy(),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_does_not_load_heavy_modules():
+    assert measure_import()['loaded'] == []
+
+
+def test_import_time_budget():
+    # best of three, so one slow start on a busy machine does not fail the run
+    best = min(measure_import()['seconds'] for _ in range(3))
+    assert best < BUDGET_SECONDS, f'import app took {best:.2f}s (budget {BUDGET_SECONDS}s)'
@@ -0,0 +1,70 @@
+"""Concurrent and repeated spreadsheet imports."""
+import os
+import threading
+
+import pandas as pd
+
+import importer
+from conftest import TMP
+from models import db, Agent, Purchase
+
+
+def write_csv(name, lines):
+    path = os.path.join(TMP, name)
+    with open(path, 'w') as f:
+        f.write('amount,note,date\n')
+        f.writelines(f'{line}\n' for line in lines)
+    return path
+
+
+def test_overlapping_files_imported_concurrently(app):
+    shared = [f'{10 + i},shared {i},2026-01-{i % 28 + 1:02d}' for i in range(300)]
+    first = write_csv('first.csv', shared + [f'1,first {i},2026-02-01' for i in range(100)])
+    second = write_csv('second.csv', shared + [f'2,second {i},2026-02-01' for i in range(100)])
+    reports, errors = [], []
+
+    def run(path):
+        try:
+            with app.app_context():
+                reports.extend(importer.import_file(path, name=os.path.basename(path)))
+                db.session.remove()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(path,)) for path in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert Purchase.query.count() == 500
+    assert sum(r['purchases'] for r in reports) == 500
+    assert sum(r['skipped'] for r in reports) == 300
+
+
+def test_username_taken_after_prefetch(app):
+    spreadsheet = importer.SpreadsheetImporter()
+    # registered by someone else once the importer has read the usernames
+    db.session.add(Agent(name='Other', username='sara'))
+    db.session.commit()
+
+    report = spreadsheet.import_frame('agents', pd.DataFrame({'name': ['Sara', 'Omar']}, index=[2, 3]))
+
+    assert report['agents'] == 2
+    usernames = {a.name: a.username for a in Agent.query}
+    assert usernames['Sara'] == 'sara.2'
+    assert usernames['Omar'] == 'omar'
+
+
+def test_identical_rows_and_rejected_rows(app):
+    path = write_csv('repeats.csv', ['5,same,2026-03-01'] * 3 + ['oops,bad,2026-03-01'] * 50)
+
+    report, = importer.import_file(path, name='repeats.csv')
+    assert report['purchases'] == 3
+    assert report['rejected'] == 50
+    assert len(report['rejected_rows']) == importer.REJECTED_SAMPLE
+    assert importer.describe_rejected(report).endswith('… +40')
+
+    again, = importer.import_file(path, name='repeats.csv')
+    assert (again['purchases'], again['skipped']) == (0, 3)
@@ -0,0 +1,19 @@
+"""Rendered invoices are cached in the app's INVOICE_CACHE_FOLDER."""
+import os
+
+from conftest import TMP
+
+
+def test_invoice_cache_follows_app_config(app, seed, admin_client):
+    seed(agents=1, rows=2)
+    folder = os.path.join(TMP, 'other-invoices')
+    app.config['INVOICE_CACHE_FOLDER'] = folder
+
+    response = admin_client.get('/income/1/invoice')
+    assert response.status_code == 200
+    assert b'T-0' in response.data
+    cached = [name for _, _, names in os.walk(folder) for name in names]
+    assert len(cached) == 1 and cached[0].startswith('1-')
+
+    # a second view is served from the cache
+    assert admin_client.get('/income/1/invoice').data == response.data
@@ -0,0 +1,62 @@
+"""Invoice numbers stay unique when incomes are added concurrently."""
+import os
+import threading
+from collections import Counter
+
+import pytest
+
+import importer
+from conftest import TMP, login
+from models import db, Income
+
+THREADS = 8
+POSTS_PER_THREAD = 10
+
+
+def post_incomes(app, results, errors):
+    try:
+        client = login(app.test_client())
+        for i in range(POSTS_PER_THREAD):
+            response = client.post('/income', data={
+                'agent_id': '1', 'amount': str(100 + i), 'source': 'walk-in',
+                'customer_name': f'Customer {threading.get_ident()}-{i}',
+                'service_type': 'Full wrap', 'car_type': 'Sedan',
+            })
+            results.append(response.status_code)
+    except Exception as e:  # surfaced by the assertions in the main thread
+        errors.append(e)
+
+
+def import_incomes(app, rows, errors):
+    path = os.path.join(TMP, 'concurrent-income.csv')
+    with open(path, 'w') as f:
+        f.write('amount,source,customer_name\n')
+        f.writelines(f'{50 + i},import,Imported {i}\n' for i in range(rows))
+    try:
+        with app.app_context():
+            importer.import_file(path, name='income.csv')
+            db.session.remove()
+    except Exception as e:
+        errors.append(e)
+
+
+@pytest.mark.parametrize('block_size', [1, 20])
+def test_concurrent_incomes_get_unique_invoice_numbers(app, seed, block_size):
+    seed(agents=1, rows=0)
+    app.config['INVOICE_BLOCK_SIZE'] = block_size
+    results, errors = [], []
+    threads = [threading.Thread(target=post_incomes, args=(app, results, errors)) for _ in range(THREADS)]
+    # a bulk import allocates its numbers from the same counter meanwhile
+    threads.append(threading.Thread(target=import_incomes, args=(app, 120, errors)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert results == [302] * (THREADS * POSTS_PER_THREAD)
+    db.session.expire_all()
+    numbers = [n for (n,) in db.session.query(Income.invoice_number)]
+    assert len(numbers) == THREADS * POSTS_PER_THREAD + 120
+    assert None not in numbers
+    assert [n for n, count in Counter(numbers).items() if count > 1] == []
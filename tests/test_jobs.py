@@ -0,0 +1,61 @@
+"""Import jobs left behind by a stopped worker."""
+import hashlib
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+from conftest import login, recorded_queries
+from models import db, FileUpload, ImportJob, Purchase
+
+CSV = b'amount,note,date\n5,a,2026-01-01\n6,b,2026-01-02\n'
+LONG_AGO = datetime.utcnow() - timedelta(hours=1)
+
+
+@pytest.fixture
+def uploaded(app):
+    """A stored upload of CSV, as left on disk by an earlier worker"""
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'orphan.csv'), 'wb') as f:
+        f.write(CSV)
+    upload = FileUpload(filename='orphan.csv', stored_name='orphan.csv', digest=hashlib.sha256(CSV).hexdigest())
+    db.session.add(upload)
+    db.session.commit()
+    jobs._recovered_pid = None
+    return upload
+
+
+def test_first_request_does_not_touch_jobs(app):
+    client = login(app.test_client())
+    with recorded_queries() as queries:
+        assert client.get('/tasks').status_code == 200
+    assert not any('import_job' in statement for statement, _ in queries)
+
+
+def test_upload_page_recovers_jobs(app, uploaded):
+    db.session.add_all([
+        ImportJob(id=1, file_id=uploaded.id, filename='orphan.csv', status='running', heartbeat_at=LONG_AGO),
+        ImportJob(id=2, file_id=uploaded.id, filename='orphan.csv', status='queued', heartbeat_at=LONG_AGO),
+    ])
+    db.session.commit()
+
+    assert login(app.test_client()).get('/files/upload').status_code == 200
+    jobs.shutdown()
+
+    db.session.expire_all()
+    assert db.session.get(ImportJob, 1).status == 'failed'
+    assert db.session.get(ImportJob, 2).status == 'done'
+    assert Purchase.query.count() == 2
+
+
+def test_waiting_job_blocks_duplicate_upload(app, uploaded):
+    # queued long ago behind other imports: its heartbeat is old but it will still run
+    db.session.add(ImportJob(file_id=uploaded.id, filename='orphan.csv', status='queued', heartbeat_at=LONG_AGO))
+    db.session.commit()
+
+    client = login(app.test_client())
+    response = client.post('/files/upload', data={'file': (io.BytesIO(CSV), 'again.csv')})
+
+    assert response.status_code == 302
+    assert ImportJob.query.count() == 1
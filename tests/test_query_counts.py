@@ -0,0 +1,36 @@
+"""List views run the same number of queries however many rows they show."""
+from datetime import date
+
+import pytest
+
+from conftest import login, recorded_queries
+
+SMALL = (2, 12)
+LARGE = (10, 120)
+
+
+def query_count(client, path):
+    client.get(path)  # warm the per-worker user and catalog caches
+    with recorded_queries() as queries:
+        response = client.get(path)
+    assert response.status_code == 200
+    return len(queries)
+
+
+@pytest.mark.parametrize('username, path', [
+    ('admin', '/income'),
+    ('admin', '/leader'),
+    ('a0', '/leader'),
+    ('admin', '/tasks'),
+    ('a0', '/tasks'),
+    ('admin', '/leader/download/{month}'),
+])
+@pytest.mark.parametrize('loading', ['joined', 'selectin'])
+def test_query_count_does_not_grow_with_rows(app, seed, username, path, loading):
+    app.config['AGENT_EAGER_LOADING'] = loading
+    path = path.format(month=date.today().strftime('%Y-%m'))
+    seed(*SMALL)
+    client = login(app.test_client(), username)
+    small = query_count(client, path)
+    seed(*LARGE)
+    assert query_count(client, path) == small
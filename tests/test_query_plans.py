@@ -0,0 +1,75 @@
+"""The month routes must reach the ledger through indexes, never a table scan."""
+import re
+from datetime import date
+
+import pytest
+
+from conftest import login, recorded_queries
+from aggregates import monthly_series, rollup_series
+from models import db, Agent, AgentMonthRollup, Purchase
+
+LEDGER_SCAN = re.compile(r'^SCAN (income|purchase|task)\b')
+
+
+def ledger_scans(queries, must_contain=''):
+    """(plan line, statement) for every ledger scan among the SELECTs containing ``must_contain``"""
+    conn = db.session.connection()
+    found = []
+    for statement, parameters in queries:
+        if not statement.lstrip().upper().startswith('SELECT') or must_contain not in statement:
+            continue
+        for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters):
+            if LEDGER_SCAN.match(row[3]):
+                found.append((row[3], statement))
+    return found
+
+
+@pytest.mark.parametrize('path', [
+    '/leader/download/{month}',
+    '/income/download/{month}',
+    '/income/invoices?month={month}',
+])
+def test_month_downloads_use_indexes(seed, admin_client, path):
+    seed()
+    with recorded_queries() as queries:
+        response = admin_client.get(path.format(month=date.today().strftime('%Y-%m')))
+    assert response.status_code == 200
+    assert queries
+    assert ledger_scans(queries) == []
+
+
+@pytest.mark.parametrize('username', ['admin', 'a0'])
+def test_leader_months_use_indexes(app, seed, username):
+    seed()
+    client = login(app.test_client(), username)
+    with recorded_queries() as queries:
+        response = client.get('/leader?page=2')
+    assert response.status_code == 200
+    # the visible months are selected with month_range() bounds on purchase.date
+    assert any('purchase.date >=' in statement for statement, _ in queries)
+    assert ledger_scans(queries, must_contain='purchase.date >=') == []
+
+
+@pytest.mark.parametrize('username', ['admin', 'a0'])
+def test_leader_month_series_from_rollups(app, seed, username):
+    seed()
+    client = login(app.test_client(), username)
+    with recorded_queries() as queries:
+        assert client.get('/leader').status_code == 200
+    # monthly_series() is the only query that needs purchase.date IS NOT NULL
+    assert not any('purchase.date IS NOT NULL' in statement for statement, _ in queries)
+
+    with recorded_queries() as queries:
+        assert client.get('/leader?from_date=2000-01-01').status_code == 200
+    assert any('purchase.date IS NOT NULL' in statement for statement, _ in queries)
+
+
+def test_rollup_series_matches_ledger(app, seed):
+    seed()
+    db.session.add(Purchase(agent_id=None, amount=7, date=None, note='undated'))
+    db.session.commit()
+    assert rollup_series('purchase') == monthly_series(Purchase)
+    agent_id = db.session.query(Agent.id).filter_by(username='a1').scalar()
+    assert rollup_series('purchase', AgentMonthRollup.agent_id == agent_id) == monthly_series(
+        Purchase, Purchase.agent_id == agent_id
+    )